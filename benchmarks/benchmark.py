@@ -0,0 +1,274 @@
+"""
+Benchmarks xlyaml and textbuilder against generated workbooks and varfiles
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import tempfile
+import argparse
+import subprocess
+
+from openpyxl import Workbook, load_workbook
+
+# Benchmarks run against the modules in the parent directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import xlyaml
+import textbuilder
+
+# Default file that benchmark results are appended to
+RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'results.jsonl')
+
+TEMPLATE = '''{% for host in hosts %}
+hostname {{ host.name }}
+ip address {{ host.ip }}
+{% for vlan in host.vlans %}vlan {{ vlan.id }} name {{ vlan.name }}
+{% endfor %}{% endfor %}
+'''
+
+def nestedRows(indent, depth, width, label):
+    '''
+    Generate the rows of a list-format block nested depth levels deep,
+    with width children at each level
+    '''
+
+    if depth == 0:
+        return [[None] * indent + [label, label + '_value']]
+    rows = [[None] * indent + [label]]
+    for idx in range(width):
+        rows.extend(nestedRows(indent + 1, depth - 1, width,
+            '%s_%d' % (label, idx)))
+    return rows
+
+def listRows(objects=100, depth=2, width=3):
+    '''
+    Generate the rows of a list-format sheet of objects; each object
+    has key-value pairs, a vlans dictionary and a nested block
+    '''
+
+    rows = []
+    for idx in range(objects):
+        if rows:
+            rows.append([None])
+        rows.append(['name', 'host%d' % idx])
+        rows.append(['ip', '10.%d.%d.1' % (idx // 256 % 256, idx % 256)])
+        rows.append(['vlans', 'id', 'name'])
+        for vlan in range(width):
+            rows.append([None, str(10 * (vlan + 1)), 'vlan%d' % vlan])
+        rows.extend(nestedRows(0, depth, width, 'block'))
+    return rows
+
+def tableRows(objects=100, columns=10):
+    '''
+    Generate the rows of a table-format sheet, header row first
+    '''
+
+    rows = [['key%d' % col for col in range(columns)]]
+    for idx in range(objects):
+        rows.append(['item%d_%d' % (idx, col) for col in range(columns)])
+    return rows
+
+def makeWorkbook(path, rows, title='hosts'):
+    '''
+    Write rows to a single-sheet workbook at path
+    '''
+
+    wb = Workbook()
+    ws = wb.active
+    ws.title = title
+    for row in rows:
+        ws.append(row)
+    wb.save(path)
+    return path
+
+def makeVarfile(path, rows):
+    '''
+    Write the YAML xlyaml produces for list-format rows to path
+    '''
+
+    collections = [xlyaml.Collection(obj) for obj in splitObjects(rows)]
+    with open(path, 'w') as f:
+        f.write(xlyaml.dumpCollections(collections))
+    return path
+
+def makeTemplate(path):
+    '''
+    Write a template rendering the hosts of a list-format varfile to path
+    '''
+
+    with open(path, 'w') as f:
+        f.write(TEMPLATE)
+    return path
+
+def splitObjects(rows):
+    '''
+    Split list-format rows into object blocks at blank rows
+    '''
+
+    objects = [[]]
+    for row in rows:
+        if any(row):
+            objects[-1].append(row)
+        else:
+            objects.append([])
+    return [obj for obj in objects if obj]
+
+def timeit(func, repeat=3, setup=None):
+    '''
+    Return the best wall time of repeat calls to func, and its last result;
+    setup, if given, is called untimed before each call
+    '''
+
+    best = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.time()
+        result = func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+def run(objects=100, depth=2, width=3, columns=10, repeat=3):
+    '''
+    Time each phase against generated inputs; returns a dict of
+    phase names to best wall time in seconds
+    '''
+
+    timings = {}
+    workdir = tempfile.mkdtemp(prefix='configbuilder-bench-')
+    cwd = os.getcwd()
+    try:
+        os.chdir(workdir)
+        rows = listRows(objects, depth, width)
+        listbook = makeWorkbook('list.xlsx', rows)
+        tablebook = makeWorkbook('table.xlsx', tableRows(objects, columns))
+        varfile = makeVarfile('hosts.yml', rows)
+        template = makeTemplate('template.txt')
+
+        ws = load_workbook(listbook)['hosts']
+        timings['sheet_parse_list'], sheet = timeit(
+            lambda: xlyaml.Sheet(ws, sourceformat='list'), repeat)
+        ws = load_workbook(tablebook)['hosts']
+        timings['sheet_parse_table'], _ = timeit(
+            lambda: xlyaml.Sheet(ws, sourceformat='table'), repeat)
+
+        objs = sheet.getCollections()
+        timings['collection_parseObject'], collections = timeit(
+            lambda: [xlyaml.Collection(obj) for obj in objs], repeat)
+        timings['buildOutput'], _ = timeit(
+            lambda: xlyaml.dumpCollections(collections), repeat)
+
+        # Every repeat parses the varfile again; the cached varfile is
+        # timed on its own
+        cache = textbuilder.get_environment(workdir).bytecode_cache.directory
+        uncache = lambda: textbuilder.evict_varcache(cache, maxsize=0)
+        timings['textbuilder'], _ = timeit(
+            lambda: textbuilder.textbuilder(template, varfile, 'results.txt',
+                cachedir=workdir), repeat, uncache)
+        timings['textbuilder_fileid'], _ = timeit(
+            lambda: textbuilder.textbuilder(template, varfile,
+                fileid='host.name', cachedir=workdir, stream=True), repeat,
+            uncache)
+        timings['textbuilder_cached'], _ = timeit(
+            lambda: textbuilder.textbuilder(template, varfile, 'results.txt',
+                cachedir=workdir), repeat)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+    return timings
+
+def gitRevision():
+    '''
+    Return the current git commit of the repository, if there is one
+    '''
+
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def record(path, params, timings):
+    '''
+    Append a benchmark result to the results file at path; returns the
+    previous result recorded with the same parameters, if any
+    '''
+
+    previous = None
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            for line in f:
+                entry = json.loads(line)
+                if entry['params'] == params:
+                    previous = entry
+    entry = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'revision': gitRevision(),
+        'params': params,
+        'timings': timings,
+        }
+    with open(path, 'a') as f:
+        f.write(json.dumps(entry, sort_keys=True))
+        f.write('\n')
+    return previous
+
+def regressions(previous, timings, threshold=0.2):
+    '''
+    Return the phases that are more than threshold slower than previous
+    '''
+
+    slower = {}
+    for phase, elapsed in timings.items():
+        before = previous['timings'].get(phase)
+        if before and elapsed > before * (1 + threshold):
+            slower[phase] = (before, elapsed)
+    return slower
+
+if __name__ == "__main__":
+    """
+    This runs if the program is called from the command line.
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--objects", type=int, default=100,
+            help="Objects per generated sheet; defaults to 100")
+    parser.add_argument("-d", "--depth", type=int, default=2,
+            help="Nesting depth of list-format blocks; defaults to 2")
+    parser.add_argument("-w", "--width", type=int, default=3,
+            help="Children per nesting level; defaults to 3")
+    parser.add_argument("-c", "--columns", type=int, default=10,
+            help="Columns of table-format sheets; defaults to 10")
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+            help="Runs per phase, best is kept; defaults to 3")
+    parser.add_argument("-o", "--results", type=str, default=RESULTS,
+            help="File results are appended to")
+    parser.add_argument("-t", "--threshold", type=float, default=0.2,
+            help="Slowdown reported as a regression; defaults to 0.2")
+    args = parser.parse_args()
+
+    # Keep log output out of the timings
+    textbuilder.setup_logging(logging.WARNING)
+    xlyaml.logger.setLevel(logging.WARNING)
+
+    params = {'objects': args.objects, 'depth': args.depth,
+        'width': args.width, 'columns': args.columns}
+    timings = run(repeat=args.repeat, **params)
+    for phase in sorted(timings):
+        print "%-24s %10.4fs" % (phase, timings[phase])
+
+    previous = record(args.results, params, timings)
+    if previous:
+        slower = regressions(previous, timings, args.threshold)
+        for phase in sorted(slower):
+            print "REGRESSION %s: %.4fs -> %.4fs (revision %s)" % \
+                ((phase,) + slower[phase] + (previous['revision'],))
+        if slower:
+            sys.exit(1)
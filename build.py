@@ -0,0 +1,104 @@
+''' Builds text files from templates and an Excel workbook in one pass '''
+
+import logging
+import argparse
+
+import xlyaml
+import textbuilder
+
+def build(source, temp, outfile='results.txt', fileid=None,
+        sourceformat='list', streaming=False, yamlout=False, cachedir=None,
+        stream=False, types=None):
+    '''
+    Returns string containing text of templates, rendered with the
+    worksheets of an Excel workbook
+
+    Each worksheet is handed to the template under its sheet name, the
+    same name textbuilder would derive from the '<sheet>.yml' file that
+    xlyaml writes, without writing and re-reading that file.
+
+    :param source: Source Excel file
+    :type source: String, containing filename
+
+    :param temp: Template file
+    :type temp: File, formatted for jinja2 processing
+
+    :param outfile: Output filename; see textbuilder
+    :type outfile: String, containing filename
+
+    :param fileid: Tag distinguishing multi-file output; see textbuilder
+    :type fileid: String
+
+    :param sourceformat: Format of the worksheets, 'list' or 'table'
+    :type sourceformat: String
+
+    :param streaming: If True, open the workbook read-only; see xlyaml
+    :type streaming: Boolean
+
+    :param yamlout: If True, also write '<sheet>.yml' for every sheet
+    :type yamlout: Boolean
+
+    :param cachedir: Directory holding compiled templates
+    :type cachedir: String, containing directory name
+
+    :param stream: If True, write output files as they are rendered;
+            see textbuilder
+    :type stream: Boolean
+
+    :param types: Column or list key types; if given, cells keep their
+            numbers, booleans and dates, see xlyaml.Sheet
+    :type types: Dict, mapping names to types
+
+    :rtype: string, or list of filenames if stream is set
+    '''
+
+    the_template = textbuilder.load_template(temp, fileid, cachedir)
+    context = xlyaml.workbookData(source, sourceformat=sourceformat,
+        streaming=streaming, output=yamlout, types=types)
+    logging.info('Variable references are %s', ', '.join(sorted(context)))
+
+    return textbuilder.build_output(the_template, context, outfile, fileid,
+        stream)
+
+if __name__ == "__main__":
+    """
+    This runs if the program is called from the command line.
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("source", type=str,
+            help="Source Excel file")
+    parser.add_argument("template", type=str,
+            help="Template file, format=Jinja2")
+    parser.add_argument("-o", "--outfile", type=str, default='results.txt',
+            help="""If outputting to a single file, this is the filename.
+            If omitted, defaults to 'results.txt'""")
+    parser.add_argument("-i", "--fileid", type=str,
+            help="""If output to multi-file, this is the tag used to
+            identify those files. Must refer to tag in a worksheet.""")
+    parser.add_argument("-f", "--sourceformat",
+            choices=['table', 'list'], default='list',
+            help="Format of Excel spreadsheet")
+    parser.add_argument("-y", "--yaml", action="store_true",
+            help="Also write a '<sheet>.yml' file for every worksheet")
+    parser.add_argument("-c", "--cachedir", type=str,
+            help="""Directory holding compiled templates. If omitted,
+            defaults to the system temporary directory""")
+    parser.add_argument("-s", "--stream", action="store_true",
+            help="""Open the workbook read-only and write each output file
+            as soon as it is rendered""")
+    parser.add_argument("--typed", action="store_true",
+            help="Hand numbers, booleans and dates to templates as they "
+            "are instead of as strings")
+    parser.add_argument("-l", "--loglevel",
+            choices=['INFO', 'DEBUG'], default='INFO',
+            help="Logging level; defaults to 'INFO'")
+    args = parser.parse_args()
+
+    level = getattr(logging, args.loglevel)
+    textbuilder.setup_logging(level)
+    xlyaml.logger.setLevel(level)
+
+    build(args.source, args.template, args.outfile, args.fileid,
+        args.sourceformat, args.stream, args.yaml, args.cachedir, args.stream,
+        {} if args.typed else None)
@@ -0,0 +1,231 @@
+''' Writes output files only when their content changes '''
+
+import os
+import json
+import hashlib
+import logging
+import threading
+import Queue
+
+# Callers decide where messages go; see xlyaml.setupLogging and
+# textbuilder.setup_logging
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+def write_output(name, chunks, digest=None):
+    '''
+    Writes the text chunks to file name, unless their SHA-1 hex digest is
+    digest and the file exists
+
+    The text is written to a temporary file that is renamed over name,
+    so readers never see a half-written file. An unchanged file is left
+    as it is, mtime included.
+
+    :rtype: tuple of (hex digest of the text, True if name was written)
+    '''
+    if isinstance(chunks, basestring):
+        chunks = [chunks]
+    if isinstance(chunks, (list, tuple)):
+        # Already in memory, so the file needn't be touched to compare
+        sha = hashlib.sha1()
+        for chunk in chunks:
+            sha.update(chunk)
+        if sha.hexdigest() == digest and os.path.exists(name):
+            return digest, False
+
+    sha = hashlib.sha1()
+    tmpname = '%s.%d.tmp' % (name, os.getpid())
+    try:
+        with open(tmpname, 'wb') as f:
+            for chunk in chunks:
+                sha.update(chunk)
+                f.write(chunk)
+        if sha.hexdigest() == digest and os.path.exists(name):
+            os.remove(tmpname)
+            return digest, False
+        os.rename(tmpname, name)
+    except:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise
+
+    return sha.hexdigest(), True
+
+class OutputManifest():
+    '''
+    Records the content hash of every file written, so that the next run
+    only writes files whose content changed
+
+    Files are recorded by group, e.g. the workbook or the template job
+    that produced them. When the manifest is saved, a file recorded by
+    the last run is removed if its group was built again but did not
+    produce it this time; groups not built this run are left alone.
+    '''
+
+    def __init__(self, path):
+        '''
+        Load the manifest at path, if there is one
+        '''
+
+        self.path = path
+        try:
+            with open(path, 'r') as f:
+                self._previous = json.load(f).get('outputs', {})
+        except (IOError, ValueError):
+            logger.debug('No usable output manifest found at %s', path)
+            self._previous = {}
+        # Files of each group built this run, and their digests
+        self._current = {}
+        # Whether each file of this run was written or skipped
+        self._status = {}
+
+    def write(self, group, name, chunks):
+        '''
+        Write the text chunks to file name for group, unless the file
+        holds them already; returns True if the file was written
+        '''
+
+        previous = self._previous.get(group, {}).get(name)
+        digest, written = write_output(name, chunks, previous)
+        self._current.setdefault(group, {})[name] = digest
+        self._status[name] = 'written' if written else 'skipped'
+        if written:
+            logger.info('Wrote %s', name)
+        else:
+            logger.info('%s is unchanged; not rewritten', name)
+        return written
+
+    def keep(self, group, names=None):
+        '''
+        Keep files of group recorded by the last run, all of them unless
+        names is given, without building them again
+        '''
+
+        previous = self._previous.get(group, {})
+        current = self._current.setdefault(group, {})
+        for name in previous if names is None else names:
+            if name in previous:
+                current[name] = previous[name]
+                self._status.setdefault(name, 'skipped')
+
+    def export(self, group):
+        '''
+        Return what this run recorded for group, for merge() in the
+        process that saves the manifest; a worker process only has a copy
+        '''
+
+        current = self._current.get(group, {})
+        return current, dict((name, self._status[name]) for name in current)
+
+    def merge(self, group, exported):
+        '''
+        Add what another process recorded for group; see export()
+        '''
+
+        current, status = exported
+        self._current.setdefault(group, {}).update(current)
+        self._status.update(status)
+
+    def save(self):
+        '''
+        Remove files that rebuilt groups no longer produce and write the
+        manifest
+
+        Returns a dict listing the files 'written', 'skipped' and
+        'removed' this run
+        '''
+
+        removed = []
+        for group, current in self._current.iteritems():
+            for name in self._previous.get(group, {}):
+                # Another group may have taken the file over
+                if name in current or name in self._status:
+                    continue
+                if os.path.exists(name):
+                    logger.info('Removing %s', name)
+                    os.remove(name)
+                removed.append(name)
+
+        outputs = dict(self._previous)
+        outputs.update(self._current)
+        tmpname = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmpname, 'w') as f:
+            json.dump({'outputs': outputs}, f, indent=2, sort_keys=True)
+        os.rename(tmpname, self.path)
+
+        summary = {'removed': sorted(removed)}
+        for state in ['written', 'skipped']:
+            summary[state] = sorted(name for name, status \
+                in self._status.iteritems() if status == state)
+        return summary
+
+class OutputWriter():
+    '''
+    Writes files on a pool of threads, so that rendering the next file
+    overlaps writing the last ones
+
+    Files are handed over through a queue holding at most queuesize of
+    them; write() blocks while it is full, which bounds the memory held
+    by rendered text waiting to be written. A file that fails to write
+    doesn't stop the others; close() reports every failure.
+    '''
+
+    def __init__(self, threads=4, queuesize=None, manifest=None):
+        '''
+        Start threads writer threads; files are written through manifest
+        if it is given, see OutputManifest
+        '''
+
+        self._manifest = manifest
+        self._queue = Queue.Queue(queuesize or 2 * threads)
+        self._failed = []
+        self._threads = []
+        for idx in range(threads):
+            thread = threading.Thread(target=self._run,
+                name='writer-%d' % idx)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            name, text, group = item
+            try:
+                if self._manifest is not None:
+                    self._manifest.write(group, name, text)
+                else:
+                    logger.info('Writing file %s', name)
+                    with open(name, 'w') as f:
+                        f.write(text)
+            except Exception as e:
+                # Any failure is reported by close(); the thread carries
+                # on, so that write() and close() never wait on a queue
+                # nobody drains
+                logger.error('Failed to write %s: %s', name, e)
+                self._failed.append((name, e))
+
+    def write(self, name, text, group=None):
+        '''
+        Queue text to be written to file name, under group if there is
+        a manifest
+        '''
+
+        self._queue.put((name, text, group))
+
+    def close(self):
+        '''
+        Wait for every queued file to be written
+
+        Raises IOError naming the files that failed, if any did
+        '''
+
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        if self._failed:
+            raise IOError('Failed to write %d files: %s' % (len(self._failed),
+                ', '.join(name for name, e in self._failed)))
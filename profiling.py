@@ -0,0 +1,240 @@
+''' Records where the time of an xlyaml or textbuilder run goes '''
+
+import os
+import json
+import time
+import logging
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; peak memory is then not reported
+    resource = None
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# Profiler of the running profile() block, if any
+_active = None
+
+def peak_memory():
+    '''
+    Returns the peak resident memory of the process so far, in kilobytes,
+    or None if it can't be measured
+    '''
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def current_memory():
+    '''
+    Returns the resident memory of the process now, in kilobytes, or
+    None if it can't be measured; only Linux reports it
+    '''
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            pages = int(f.read().split()[1])
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+    return pages * (os.sysconf('SC_PAGE_SIZE') // 1024)
+
+def _growth(before, after):
+    if before is None or after is None:
+        return None
+    return after - before
+
+class Timer():
+    '''
+    Adds the wall time of a with block to a phase of a Profiler, and to
+    the phase's entry for item if item is given
+
+    If exclusive is True, time spent producing the items of timed()
+    iterables during the block is left out; e.g. the rendering of a
+    streamed file that is consumed while the file is written.
+    '''
+
+    def __init__(self, profiler, name, item, exclusive=False):
+        self._profiler = profiler
+        self._name = name
+        self._item = item
+        self._exclusive = exclusive
+
+    def __enter__(self):
+        self._memory = current_memory()
+        self._start = time.time()
+        self._iterated = self._profiler.iterated
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.time() - self._start
+        if self._exclusive:
+            seconds -= self._profiler.iterated - self._iterated
+        self._profiler.add(self._name, self._item, seconds,
+            _growth(self._memory, current_memory()))
+        return False
+
+class NullTimer():
+    '''
+    Stands in for Timer when nothing is being profiled
+    '''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_null_timer = NullTimer()
+
+class Profiler():
+    '''
+    Collects wall time, call counts and memory by phase, e.g.
+    'load_workbook' or 'render', and by the sheet or file each call of
+    a phase worked on
+
+    The memory of a phase is 'memory_growth_kb', the most the resident
+    memory of the process grew over one call of the phase, and 'rss_kb',
+    the most resident memory seen at the end of a call. The report's
+    'peak_memory_kb' is the high-water mark of the whole run.
+
+    Only the process that runs the profile() block is measured; work
+    done by worker processes shows up as the time the parent waited.
+    '''
+
+    def __init__(self, cprofile=False):
+        self._phases = {}
+        # Seconds spent producing the items of timed() iterables so far
+        self.iterated = 0.0
+        self._start = time.time()
+        self._end = None
+        self._cprofile = None
+        if cprofile:
+            import cProfile
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+
+    def add(self, name, item, seconds, growth=None):
+        '''
+        Add a call of seconds to phase name, and to its entry for item,
+        during which resident memory grew by growth kilobytes
+        '''
+        memory = current_memory()
+        entries = [self._phases.setdefault(name,
+            {'calls': 0, 'seconds': 0.0, 'memory_growth_kb': None,
+            'rss_kb': None, 'items': {}})]
+        if item is not None:
+            entries.append(entries[0]['items'].setdefault(str(item),
+                {'calls': 0, 'seconds': 0.0, 'memory_growth_kb': None,
+                'rss_kb': None}))
+        for entry in entries:
+            entry['calls'] += 1
+            entry['seconds'] += seconds
+            entry['memory_growth_kb'] = max(entry['memory_growth_kb'],
+                growth)
+            entry['rss_kb'] = max(entry['rss_kb'], memory)
+
+    def stop(self):
+        '''
+        Stop measuring, and the cProfile capture if there is one
+        '''
+        self._end = time.time()
+        if self._cprofile is not None:
+            self._cprofile.disable()
+
+    def report(self):
+        '''
+        Returns the measurements as a dict that can be dumped to JSON
+        '''
+        return {
+            'seconds': (self._end or time.time()) - self._start,
+            'peak_memory_kb': peak_memory(),
+            'phases': self._phases,
+            }
+
+    def write(self, report=None, cprofile=None):
+        '''
+        Writes the JSON report to file report, and the cProfile capture,
+        in pstats format, to file cprofile
+        '''
+        if report:
+            with open(report, 'w') as f:
+                json.dump(self.report(), f, indent=2, sort_keys=True)
+            logger.info('Wrote profile report %s', report)
+        if cprofile and self._cprofile is not None:
+            self._cprofile.dump_stats(cprofile)
+            logger.info('Wrote cProfile capture %s', cprofile)
+
+class profile():
+    '''
+    Profiles the xlyaml and textbuilder calls made in a with block; e.g.:
+        with profiling.profile('report.json') as profiler:
+            xlyaml.xlyaml('site.xlsx')
+        print profiler.report()['phases']['load_workbook']
+
+    The JSON report is written to report and, if cprofile names a file,
+    a cProfile capture of the block is written to it; see Profiler.write.
+    Nothing is profiled if enabled is False.
+    '''
+
+    def __init__(self, report=None, cprofile=None, enabled=True):
+        self._report = report
+        self._cprofile = cprofile
+        self._enabled = enabled
+
+    def __enter__(self):
+        global _active
+        if not self._enabled:
+            return None
+        self._previous = _active
+        _active = Profiler(cprofile=bool(self._cprofile))
+        return _active
+
+    def __exit__(self, *exc_info):
+        global _active
+        if not self._enabled:
+            return False
+        profiler = _active
+        _active = self._previous
+        profiler.stop()
+        profiler.write(self._report, self._cprofile)
+        return False
+
+def phase(name, item=None, exclusive=False):
+    '''
+    Returns a context manager timing its with block as a call of phase
+    name for item, if a profile() block is running; otherwise it does
+    nothing. See Timer for exclusive.
+    '''
+    if _active is None:
+        return _null_timer
+    return Timer(_active, name, item, exclusive)
+
+def timed(name, iterable, item=None):
+    '''
+    Returns iterable, timing the work of producing its items as one call
+    of phase name for item if a profile() block is running
+
+    This times generators that do their work as they are consumed, e.g.
+    a streamed render; the time the consumer spends on each item is not
+    counted. The call is added once the iterable is exhausted or closed.
+    '''
+    if _active is None:
+        return iterable
+    return _timed(_active, name, iterable, item)
+
+def _timed(profiler, name, iterable, item):
+    iterator = iter(iterable)
+    memory = current_memory()
+    seconds = 0.0
+    try:
+        while True:
+            start = time.time()
+            try:
+                value = next(iterator)
+            finally:
+                elapsed = time.time() - start
+                seconds += elapsed
+                profiler.iterated += elapsed
+            yield value
+    finally:
+        profiler.add(name, item, seconds, _growth(memory, current_memory()))
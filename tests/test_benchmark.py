@@ -0,0 +1,20 @@
+import xlyaml
+from benchmarks import benchmark
+
+def test_benchmark_list_rows_parse_into_generated_objects(tmpdir):
+	rows = benchmark.listRows(objects=3, depth=2, width=2)
+	path = benchmark.makeWorkbook(str(tmpdir.join('list.xlsx')), rows)
+	sheet = xlyaml.Sheet(benchmark.load_workbook(path)['hosts'])
+	collections = [xlyaml.Collection(obj) for obj in sheet.getCollections()]
+
+	assert len(collections) == 3
+	assert collections[2].collection[0]['name'] == 'host2'
+	assert collections[0].collection[0]['vlans'] == \
+		[{'id': '10', 'name': 'vlan0'}, {'id': '20', 'name': 'vlan1'}]
+
+def test_benchmark_run_times_every_phase():
+	timings = benchmark.run(objects=2, depth=1, width=2, columns=3, repeat=1)
+
+	assert sorted(timings) == ['buildOutput', 'collection_parseObject', \
+		'sheet_parse_list', 'sheet_parse_table', 'textbuilder', \
+		'textbuilder_cached', 'textbuilder_fileid']
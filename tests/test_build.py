@@ -0,0 +1,57 @@
+from openpyxl import Workbook
+import xlyaml
+import textbuilder
+import build
+
+TEMPLATE = '''{% for host in switches %}
+hostname {{ host.name }}
+{% for vlan in host.vlans %}vlan {{ vlan.id }} name {{ vlan.name }}
+{% endfor %}{% endfor %}
+'''
+
+ROWS = [ \
+	['name', 'sw1', None], \
+	['vlans', 'id', 'name'], \
+	[None, '10', 'users'], \
+	[None, '20', 'voice'], \
+	[None, None, None], \
+	['name', 'sw2', None], \
+	['vlans', 'id', 'name'], \
+	[None, '30', 'servers'] \
+	]
+
+def write_inputs(tmpdir):
+	wb = Workbook()
+	wb.active.title = 'switches'
+	for row in ROWS:
+		wb.active.append(row)
+	wb.save(str(tmpdir.join('site.xlsx')))
+	tmpdir.join('template.txt').write(TEMPLATE)
+	return str(tmpdir.join('site.xlsx')), str(tmpdir.join('template.txt'))
+
+def test_build_matches_xlyaml_then_textbuilder(tmpdir):
+	source, temp = write_inputs(tmpdir)
+	with tmpdir.as_cwd():
+		xlyaml.xlyaml(source)
+		expected = textbuilder.textbuilder(temp, 'switches.yml', \
+			'expected.txt', cachedir=str(tmpdir))
+		tmpdir.join('switches.yml').remove()
+		result = build.build(source, temp, 'results.txt', \
+			cachedir=str(tmpdir))
+
+	assert result == expected
+	assert tmpdir.join('results.txt').read() == expected
+	assert not tmpdir.join('switches.yml').check()
+
+def test_build_writes_yaml_side_output(tmpdir):
+	source, temp = write_inputs(tmpdir)
+	with tmpdir.as_cwd():
+		xlyaml.xlyaml(source)
+		expected = tmpdir.join('switches.yml').read()
+		tmpdir.join('switches.yml').remove()
+		build.build(source, temp, fileid='host.name', yamlout=True, \
+			cachedir=str(tmpdir))
+
+	assert tmpdir.join('switches.yml').read() == expected
+	assert tmpdir.join('sw2.txt').read() == \
+		'hostname sw2\nvlan 30 name servers\n'
@@ -0,0 +1,87 @@
+import json
+import time
+import pstats
+from openpyxl import Workbook
+import profiling
+import textbuilder
+import xlyaml
+
+TEMPLATE = '''{% for host in switches %}
+hostname {{ host.name }}
+{% endfor %}
+'''
+
+def test_profile_records_phases_by_sheet_and_file(tmpdir):
+	source = str(tmpdir.join('site.xlsx'))
+	wb = Workbook()
+	wb.active.title = 'switches'
+	for name in ['sw1', 'sw2']:
+		wb['switches'].append(['name', name])
+		wb['switches'].append([None])
+	wb.save(source)
+	tmpdir.join('template.txt').write(TEMPLATE)
+	report = str(tmpdir.join('report.json'))
+	stats = str(tmpdir.join('run.prof'))
+	with tmpdir.as_cwd():
+		with profiling.profile(report, stats) as profiler:
+			xlyaml.xlyaml(source)
+			textbuilder.textbuilder('template.txt', 'switches.yml', \
+				fileid='host.name', cachedir=str(tmpdir))
+
+	phases = json.load(open(report))['phases']
+	assert phases == json.loads(json.dumps(profiler.report()['phases']))
+	for name in ['load_workbook', 'sheet', 'parse', 'parseObject', 'dump', \
+			'write', 'load_template', 'load_varfile', 'render']:
+		assert phases[name]['calls'] > 0, name
+	assert phases['parseObject']['items']['switches']['calls'] == 2
+	assert sorted(phases['write']['items']) == \
+		['sw1.txt', 'sw2.txt', 'switches.yml']
+	assert phases['sheet']['items']['switches']['seconds'] >= \
+		phases['parseObject']['items']['switches']['seconds']
+	assert pstats.Stats(stats).total_calls > 0
+
+def test_phase_does_nothing_outside_profile():
+	with profiling.phase('parse', 'sheet'):
+		pass
+	with profiling.profile() as profiler:
+		pass
+	assert profiler.report()['phases'] == {}
+
+def test_streamed_render_is_timed_apart_from_write(tmpdir):
+	def chunks():
+		for idx in range(3):
+			time.sleep(0.02)
+			yield 'chunk%d\n' % idx
+
+	with profiling.profile() as profiler:
+		with profiling.phase('write', 'out.txt', exclusive=True):
+			text = ''.join(profiling.timed('render', chunks(), 'template'))
+	phases = profiler.report()['phases']
+	assert text == 'chunk0\nchunk1\nchunk2\n'
+	assert phases['render']['calls'] == 1
+	assert phases['render']['seconds'] >= 0.06
+	assert phases['write']['seconds'] < 0.03
+
+	tmpdir.join('template.txt').write(TEMPLATE)
+	tmpdir.join('switches.yml').write('- name: sw1\n- name: sw2\n')
+	with tmpdir.as_cwd():
+		with profiling.profile() as profiler:
+			textbuilder.batchbuilder([{'template': 'template.txt', \
+				'varfile': 'switches.yml', 'fileid': 'host.name'}], \
+				cachedir=str(tmpdir))
+	assert profiler.report()['phases']['render']['calls'] == 1
+
+def test_phase_memory_is_measured_per_call():
+	with profiling.profile() as profiler:
+		with profiling.phase('load', 'big'):
+			data = 'x' * (64 * 1024 * 1024)
+		del data
+		with profiling.phase('small', 'item'):
+			pass
+	phases = profiler.report()['phases']
+	if profiling.current_memory() is None:
+		assert phases['load']['memory_growth_kb'] is None
+	else:
+		assert phases['load']['items']['big']['memory_growth_kb'] >= 60000
+		assert phases['small']['memory_growth_kb'] < 60000
+		assert phases['small']['rss_kb'] < phases['load']['rss_kb']
@@ -0,0 +1,30 @@
+import os
+import sys
+import subprocess
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY = ['yaml', 'jinja2', 'openpyxl', 'multiprocessing']
+
+def run(args):
+	start = time.time()
+	subprocess.check_call([sys.executable] + args, cwd=ROOT, \
+		stdout=open(os.devnull, 'w'))
+	return time.time() - start
+
+def best(args, repeat=3):
+	return min(run(args) for _ in range(repeat))
+
+def test_import_does_not_load_heavy_dependencies():
+	for module in ['xlyaml', 'textbuilder', 'build', 'watch']:
+		code = 'import sys, %s; print(sorted(m for m in %r if m in sys.modules))' \
+			% (module, HEAVY)
+		loaded = subprocess.check_output([sys.executable, '-c', code], \
+			cwd=ROOT)
+		assert loaded.strip() == '[]', module
+
+def test_help_starts_quickly():
+	baseline = best(['-c', 'pass'])
+	for script in ['xlyaml.py', 'textbuilder.py']:
+		assert best([script, '--help']) - baseline < 0.25, script
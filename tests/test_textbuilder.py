@@ -0,0 +1,295 @@
+import pytest
+import yaml
+import textbuilder
+import xlyaml
+
+TEMPLATE = '''{% for host in switches.hosts %}
+hostname {{ host.name }}
+ip address {{ host.ip }}
+{% endfor %}
+'''
+
+VARFILE = '''hosts:
+- name: sw1
+  ip: 10.0.0.1
+- name: sw2
+  ip: 10.0.0.2
+'''
+
+def write_inputs(tmpdir):
+	tmpdir.join('template.txt').write(TEMPLATE)
+	tmpdir.join('switches.yml').write(VARFILE)
+	return str(tmpdir.join('template.txt')), str(tmpdir.join('switches.yml'))
+
+def test_textbuilder_renders_single_file(tmpdir):
+	temp, varfile = write_inputs(tmpdir)
+	outfile = str(tmpdir.join('results.txt'))
+	result = textbuilder.textbuilder(temp, varfile, outfile, \
+		cachedir=str(tmpdir))
+
+	assert result == '\nhostname sw1\nip address 10.0.0.1\n' \
+		'\nhostname sw2\nip address 10.0.0.2\n'
+	assert tmpdir.join('results.txt').read() == result
+
+def test_textbuilder_renders_multi_file(tmpdir):
+	temp, varfile = write_inputs(tmpdir)
+	with tmpdir.as_cwd():
+		textbuilder.textbuilder(temp, varfile, fileid='host.name', \
+			cachedir=str(tmpdir))
+
+	assert tmpdir.join('sw1.txt').read() == \
+		'hostname sw1\nip address 10.0.0.1\n\n'
+	assert tmpdir.join('sw2.txt').read() == \
+		'hostname sw2\nip address 10.0.0.2\n'
+
+def test_textbuilder_reuses_compiled_template(tmpdir):
+	temp, varfile = write_inputs(tmpdir)
+	outfile = str(tmpdir.join('results.txt'))
+	environment = textbuilder.get_environment(str(tmpdir))
+	textbuilder.textbuilder(temp, varfile, outfile, cachedir=str(tmpdir))
+	first = environment.get_template(temp)
+	textbuilder.textbuilder(temp, varfile, outfile, cachedir=str(tmpdir))
+
+	assert environment.get_template(temp) is first
+	assert tmpdir.listdir(lambda p: p.basename.startswith('__jinja2_'))
+
+def test_textbuilder_stream_matches_multi_file(tmpdir):
+	temp, varfile = write_inputs(tmpdir)
+	with tmpdir.as_cwd():
+		textbuilder.textbuilder(temp, varfile, fileid='host.name', \
+			cachedir=str(tmpdir))
+		expected = [tmpdir.join(name).read() for name in ['sw1.txt', 'sw2.txt']]
+		written = textbuilder.textbuilder(temp, varfile, fileid='host.name', \
+			cachedir=str(tmpdir), stream=True)
+
+	assert written == ['sw1.txt', 'sw2.txt']
+	assert [tmpdir.join(name).read() for name in written] == expected
+
+def test_split_stream_handles_separator_across_chunks():
+	chunks = ['\nXY', 'Zsw1X', 'YZconf', 'ig1XYZsw2', 'XYZ', 'config2']
+
+	assert list(textbuilder.split_stream(chunks, 'XYZ')) == \
+		['\n', 'sw1', 'config1', 'sw2', 'config2']
+
+def test_batchbuilder_matches_textbuilder(tmpdir):
+	temp, varfile = write_inputs(tmpdir)
+	tmpdir.mkdir('routers').join('switches.yml').write( \
+		VARFILE.replace('sw', 'rt'))
+	routers = str(tmpdir.join('routers', 'switches.yml'))
+	with tmpdir.as_cwd():
+		expected = textbuilder.textbuilder(temp, routers, 'expected.txt', \
+			cachedir=str(tmpdir))
+		jobs = [ \
+			{'template': temp, 'varfile': varfile, 'fileid': 'host.name'}, \
+			{'template': temp, 'varfile': routers, 'outfile': 'routers.txt'} \
+			]
+		written = textbuilder.batchbuilder(jobs, processes=2, \
+			cachedir=str(tmpdir))
+
+	assert written == [['sw1.txt', 'sw2.txt'], ['routers.txt']]
+	assert tmpdir.join('routers.txt').read() == expected
+	assert tmpdir.join('sw2.txt').read() == \
+		'hostname sw2\nip address 10.0.0.2\n'
+
+def test_glob_jobs_pairs_every_template_with_every_varfile(tmpdir):
+	for name in ['a.txt', 'b.txt', 'x.yml', 'y.yml']:
+		tmpdir.join(name).write('')
+	jobs = textbuilder.glob_jobs(str(tmpdir.join('*.txt')), \
+		str(tmpdir.join('*.yml')))
+
+	assert [job['outfile'] for job in jobs] == \
+		['a_x.txt', 'a_y.txt', 'b_x.txt', 'b_y.txt']
+
+def test_textbuilder_loads_json_and_marshal_varfiles(tmpdir):
+	collections = [xlyaml.Collection([['name', 'sw1'], ['ip', '10.0.0.1']]), \
+		xlyaml.Collection([['name', 'sw2'], ['ip', '10.0.0.2']])]
+	tmpdir.join('template.txt').write(TEMPLATE.replace('.hosts', ''))
+	temp = str(tmpdir.join('template.txt'))
+	results = []
+	for format in ['yaml', 'json', 'marshal']:
+		subdir = tmpdir.mkdir(format)
+		with subdir.as_cwd():
+			varfile = xlyaml.writeSheet('switches', collections, format=format)
+			results.append(textbuilder.textbuilder(temp, \
+				str(subdir.join(varfile)), str(subdir.join('results.txt')), \
+				cachedir=str(tmpdir)))
+
+	assert results[0] == results[1] == results[2]
+	assert 'ip address 10.0.0.2' in results[0]
+
+def test_load_varfile_skips_parsing_unchanged_varfile(tmpdir, monkeypatch):
+	temp, varfile = write_inputs(tmpdir)
+	cachedir = str(tmpdir.mkdir('cache'))
+	expected = textbuilder.load_varfile(varfile, cachedir)
+
+	def fail(*args, **kwargs):
+		raise AssertionError('varfile was parsed again')
+	monkeypatch.setattr(yaml, 'load', fail)
+	assert textbuilder.load_varfile(varfile, cachedir) == expected
+
+	monkeypatch.undo()
+	tmpdir.join('switches.yml').write(VARFILE.replace('sw2', 'sw3'))
+	varref, vars = textbuilder.load_varfile(varfile, cachedir)
+	assert vars['hosts'][1]['name'] == 'sw3'
+
+def test_evict_varcache_removes_least_recently_used(tmpdir):
+	for idx, name in enumerate(['a', 'b', 'c']):
+		entry = tmpdir.join(textbuilder.VARCACHE_PATTERN % name)
+		entry.write('x' * 10)
+		entry.setmtime(1000000000 + idx)
+	textbuilder.evict_varcache(str(tmpdir), maxsize=20)
+
+	assert sorted(p.basename for p in tmpdir.listdir()) == \
+		[textbuilder.VARCACHE_PATTERN % 'b', textbuilder.VARCACHE_PATTERN % 'c']
+
+def test_template_dependencies_follow_includes(tmpdir):
+	header = tmpdir.join('header.txt')
+	header.write('site {{ site.name }}\n')
+	tmpdir.join('template.txt').write("{%% include '%s' %%}\n%s" \
+		% (header, TEMPLATE))
+	variables, templates = textbuilder.template_dependencies( \
+		str(tmpdir.join('template.txt')), str(tmpdir))
+
+	assert variables == set(['site', 'switches'])
+	assert templates == set([str(tmpdir.join('template.txt')), str(header)])
+
+def test_batchbuilder_renders_only_changed_jobs(tmpdir):
+	temp, varfile = write_inputs(tmpdir)
+	tmpdir.join('static.txt').write('banner\n')
+	jobs = [ \
+		{'template': temp, 'varfile': varfile, 'outfile': 'hosts.txt'}, \
+		{'template': str(tmpdir.join('static.txt')), 'varfile': varfile, \
+			'outfile': 'static.txt.out'} \
+		]
+	with tmpdir.as_cwd():
+		build = lambda: textbuilder.batchbuilder(jobs, \
+			cachedir=str(tmpdir), changed=True)
+		assert build() == [['hosts.txt'], ['static.txt.out']]
+		assert build() == [[], []]
+
+		# static.txt does not reference switches
+		tmpdir.join('switches.yml').write(VARFILE.replace('sw2', 'sw3'))
+		assert build() == [['hosts.txt'], []]
+		assert 'hostname sw3' in tmpdir.join('hosts.txt').read()
+
+		tmpdir.join('static.txt.out').remove()
+		assert build() == [[], ['static.txt.out']]
+
+def test_textbuilder_outputs_skips_unchanged_and_removes_stale_files(tmpdir):
+	temp, varfile = write_inputs(tmpdir)
+	with tmpdir.as_cwd():
+		build = lambda: textbuilder.textbuilder(temp, varfile, \
+			fileid='host.name', cachedir=str(tmpdir), outputs='outputs.json')
+		build()
+		tmpdir.join('sw1.txt').setmtime(1000000000)
+		tmpdir.join('sw2.txt').setmtime(1000000000)
+
+		tmpdir.join('switches.yml').write( \
+			VARFILE.replace('10.0.0.2', '10.0.0.9'))
+		build()
+		assert tmpdir.join('sw1.txt').mtime() == 1000000000
+		assert tmpdir.join('sw2.txt').read() == \
+			'hostname sw2\nip address 10.0.0.9\n'
+
+		tmpdir.join('switches.yml').write(VARFILE.replace('sw2', 'sw3'))
+		build()
+		assert not tmpdir.join('sw2.txt').exists()
+		assert tmpdir.join('sw3.txt').exists()
+		assert tmpdir.join('sw1.txt').mtime() == 1000000000
+
+def test_textbuilder_writer_threads_match_inline_writes(tmpdir):
+	temp, varfile = write_inputs(tmpdir)
+	with tmpdir.as_cwd():
+		textbuilder.textbuilder(temp, varfile, fileid='host.name', \
+			cachedir=str(tmpdir))
+		expected = [tmpdir.join(name).read() for name in ['sw1.txt', 'sw2.txt']]
+		for stream in [False, True]:
+			for name in ['sw1.txt', 'sw2.txt']:
+				tmpdir.join(name).remove()
+			written = textbuilder.textbuilder(temp, varfile, \
+				fileid='host.name', cachedir=str(tmpdir), stream=stream, \
+				writers=4)
+			assert [tmpdir.join(name).read() \
+				for name in ['sw1.txt', 'sw2.txt']] == expected
+	assert written == ['sw1.txt', 'sw2.txt']
+
+def test_textbuilder_writer_threads_report_failed_writes(tmpdir):
+	temp, varfile = write_inputs(tmpdir)
+	tmpdir.mkdir('sw1.txt')
+	with tmpdir.as_cwd():
+		with pytest.raises(IOError) as excinfo:
+			textbuilder.textbuilder(temp, varfile, fileid='host.name', \
+				cachedir=str(tmpdir), stream=True, writers=2)
+	assert 'sw1.txt' in str(excinfo.value)
+	assert tmpdir.join('sw2.txt').check(file=1)
+
+def test_textbuilder_writer_threads_report_non_io_failures(tmpdir):
+	temp, varfile = write_inputs(tmpdir)
+	tmpdir.join('template.txt').write(TEMPLATE.replace('ip address', \
+		'adresse IP \xc3\xa9'), 'wb')
+	with tmpdir.as_cwd():
+		with pytest.raises(IOError) as excinfo:
+			textbuilder.textbuilder(temp, varfile, fileid='host.name', \
+				cachedir=str(tmpdir), stream=True, writers=2)
+	assert 'sw1.txt' in str(excinfo.value)
+	assert 'sw2.txt' in str(excinfo.value)
+
+def test_textbuilder_shards_match_serial_multi_file(tmpdir):
+	hosts = ['- name: sw%d\n  ip: 10.0.0.%d\n' % (idx, idx) \
+		for idx in range(7)]
+	tmpdir.join('template.txt').write(TEMPLATE + 'after\n')
+	tmpdir.join('switches.yml').write('hosts:\n' + ''.join(hosts))
+	temp = str(tmpdir.join('template.txt'))
+	varfile = str(tmpdir.join('switches.yml'))
+	names = ['sw%d.txt' % idx for idx in range(7)]
+	with tmpdir.as_cwd():
+		textbuilder.textbuilder(temp, varfile, fileid='host.name', \
+			cachedir=str(tmpdir))
+		expected = [tmpdir.join(name).read() for name in names]
+		for shards in [2, 3, 7, 10]:
+			for name in names:
+				tmpdir.join(name).remove()
+			written = textbuilder.textbuilder(temp, varfile, \
+				fileid='host.name', cachedir=str(tmpdir), shards=shards, \
+				writers=1 + shards % 2)
+			assert written == names
+			assert [tmpdir.join(name).read() for name in names] == expected
+
+def test_loop_collection_rejects_loops_that_cannot_be_sharded(tmpdir):
+	templates = { \
+		'{% for host in switches.hosts %}\n{{ host.name }}\n{% endfor %}': \
+			['switches', 'hosts'], \
+		'{% for host in data["sw"][0] %}\n{{ host }}\n{% endfor %}': \
+			['data', 'sw', 0], \
+		'{% for host in hosts %}\n{{ loop.index }}\n{% endfor %}': None, \
+		'{% for host in hosts if host %}\n{{ host }}\n{% endfor %}': None, \
+		'{% for host in hosts|sort %}\n{{ host }}\n{% endfor %}': None, \
+		'header\n{% for host in hosts %}\n{{ host }}\n{% endfor %}': None, \
+		'{% for host in switches.hosts %}\n{{ switches.hosts|length }} ' \
+			'{{ switches.hosts[0].name }}\n{% endfor %}': None, \
+		'{% for host in hosts %}\n{{ host }}\n{% else %}{{ hosts }}' \
+			'{% endfor %}': None, \
+		}
+	for idx, (source, keys) in enumerate(sorted(templates.items())):
+		tmpdir.join('t%d.txt' % idx).write(source)
+		the_template = textbuilder.load_template( \
+			str(tmpdir.join('t%d.txt' % idx)), 'host', str(tmpdir))
+		assert textbuilder.loop_collection(the_template) == keys, source
+
+def test_loop_collection_follows_included_templates(tmpdir):
+	parts = {'length.txt': 'of {{ hosts|length }}', \
+		'index.txt': '{{ loop.index }}', 'name.txt': '{{ host }}'}
+	for name, source in parts.items():
+		tmpdir.join(name).write(source)
+	templates = { \
+		'name.txt': ['hosts'], \
+		'length.txt': None, \
+		'index.txt': None, \
+		'missing.txt': None, \
+		}
+	for idx, (part, keys) in enumerate(sorted(templates.items())):
+		tmpdir.join('t%d.txt' % idx).write('{% for host in hosts %}\n' \
+			'{% include "' + str(tmpdir.join(part)) + '" %}\n{% endfor %}')
+		the_template = textbuilder.load_template( \
+			str(tmpdir.join('t%d.txt' % idx)), 'host', str(tmpdir))
+		assert textbuilder.loop_collection(the_template) == keys, part
@@ -0,0 +1,72 @@
+import os
+from openpyxl import Workbook
+import watch
+
+TEMPLATE = '''{% for host in switches %}
+hostname {{ host.name }}
+{% endfor %}
+'''
+
+def save_workbook(path, names):
+	wb = Workbook()
+	wb.active.title = 'switches'
+	wb.create_sheet(title='routers')
+	for name in names:
+		wb['switches'].append(['name', name])
+		wb['switches'].append([None])
+	wb['routers'].append(['name', 'rt1'])
+	wb.save(path)
+
+def touch_later(path):
+	stat = os.stat(path)
+	os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+
+def test_watcher_rebuilds_only_what_changed(tmpdir):
+	source = str(tmpdir.join('site.xlsx'))
+	temp = str(tmpdir.join('template.txt'))
+	save_workbook(source, ['sw1'])
+	tmpdir.join('template.txt').write(TEMPLATE)
+	jobs = [{'template': temp, 'varfile': 'switches.yml', \
+		'outfile': 'results.txt'}]
+	with tmpdir.as_cwd():
+		watcher = watch.Watcher([source], jobs, cachedir=str(tmpdir))
+		first = watcher.poll()
+		assert sorted(os.path.basename(p) for p in first['sheets']) == \
+			['routers.yml', 'switches.yml']
+		assert first['renders'] == ['results.txt']
+
+		assert watcher.poll() == {'sheets': [], 'renders': []}
+
+		save_workbook(source, ['sw1', 'sw2'])
+		touch_later(source)
+		second = watcher.poll()
+		assert [os.path.basename(p) for p in second['sheets']] == \
+			['switches.yml']
+		assert second['renders'] == ['results.txt']
+		assert 'hostname sw2' in tmpdir.join('results.txt').read()
+
+		tmpdir.join('template.txt').write(TEMPLATE.replace('hostname', 'host'))
+		touch_later(temp)
+		third = watcher.poll()
+		assert third == {'sheets': [], 'renders': ['results.txt']}
+		assert 'host sw2' in tmpdir.join('results.txt').read()
+
+def test_watcher_rerenders_when_included_template_changes(tmpdir):
+	source = str(tmpdir.join('site.xlsx'))
+	part = str(tmpdir.join('part.txt'))
+	save_workbook(source, ['sw1'])
+	tmpdir.join('part.txt').write('hostname {{ host.name }}')
+	tmpdir.join('template.txt').write('{% for host in switches %}\n' \
+		'{% include "' + part + '" %}\n{% endfor %}\n')
+	jobs = [{'template': str(tmpdir.join('template.txt')), \
+		'varfile': 'switches.yml', 'outfile': 'results.txt'}]
+	with tmpdir.as_cwd():
+		watcher = watch.Watcher([source], jobs, cachedir=str(tmpdir))
+		assert watcher.poll()['renders'] == ['results.txt']
+		assert watcher.poll() == {'sheets': [], 'renders': []}
+
+		tmpdir.join('part.txt').write('host {{ host.name }}')
+		touch_later(part)
+		assert watcher.poll() == {'sheets': [], 'renders': ['results.txt']}
+		assert 'host sw1' in tmpdir.join('results.txt').read()
+		assert watcher.poll() == {'sheets': [], 'renders': []}
@@ -0,0 +1,19 @@
+import pytest
+from workers import worker_pool
+
+def square(value):
+	return value * value
+
+def test_worker_pool_maps_in_worker_processes():
+	with worker_pool(2) as pool:
+		results = pool.map(square, range(4))
+
+	assert results == [0, 1, 4, 9]
+
+def test_worker_pool_terminates_on_error():
+	with pytest.raises(ZeroDivisionError):
+		with worker_pool(2) as pool:
+			pool.map(square, range(2))
+			1 / 0
+
+	assert not any(process.is_alive() for process in pool._pool)
@@ -1,3 +1,4 @@
+import pytest
 import yaml
 import xlyaml
 
@@ -15,4 +16,84 @@ def test_collection_class_buildOutput_builds_valid_yaml():
 	collection_object = xlyaml.Collection(sheet_object)
 
 	assert collection_object.collection == \
-		yaml.load(collection_object.buildOutput())
\ No newline at end of file
+		yaml.load(collection_object.buildOutput())
+
+def test_collection_class_buildTree_matches_collapseTree():
+	sheet_object = [ \
+		['hostname', 'sw1', None, None, None], \
+		['interfaces', None, None, None, None], \
+		[None, 'Gi1/0/1', None, None, None], \
+		[None, None, 'vlans', None, None], \
+		[None, None, None, '10', None], \
+		[None, None, None, '20', None], \
+		[None, None, 'mode', 'trunk', None], \
+		[None, 'Gi1/0/2', None, None, None], \
+		[None, None, 'mode', 'access', None], \
+		['ntp', 'name', 'ip', None, None], \
+		[None, 'ntp1', '10.0.0.1', None, None], \
+		[None, 'ntp2', '10.0.0.2', None, None], \
+		['domains', 'a.example', 'b.example', None, None], \
+		['orphan', None, None, None, None] \
+		]
+	collection_object = xlyaml.Collection([])
+
+	assert collection_object.parseObject(sheet_object) == \
+		collection_object.parseObject(sheet_object, linear=False)
+	assert collection_object.parseObject(sheet_object)[0]['interfaces'] == \
+		[{'Gi1/0/1': [{'vlans': ['10', '20']}, {'mode': 'trunk'}]}, \
+		{'Gi1/0/2': [{'mode': 'access'}]}]
+
+
+@pytest.mark.skipif(not yaml.__with_libyaml__, reason='requires libyaml')
+def test_collection_class_buildOutput_same_with_and_without_libyaml():
+	sheet_object = [ \
+		['key1', 'value: 1', None], \
+		['yes', '10', None], \
+		['list1', None, None], \
+		[None, '- item', None], \
+		[None, 'x' * 120 + ' y' * 40, None], \
+		['dict1', 'd1_key1', 'd1_key2'], \
+		[None, 'd1_k1_v1', 'd1_k2_v1'] \
+		]
+	collection = xlyaml.Collection(sheet_object).collection
+	pure = yaml.dump(collection, Dumper=yaml.SafeDumper, \
+		default_flow_style=False)
+	libyaml = yaml.dump(collection, Dumper=yaml.CSafeDumper, \
+		default_flow_style=False)
+
+	assert libyaml == pure
+	assert yaml.load(pure, Loader=yaml.CSafeLoader) == \
+		yaml.load(pure, Loader=yaml.SafeLoader) == collection
+
+def test_dumpCollections_matches_joined_buildOutput():
+	collections = [ \
+		xlyaml.Collection([['key1', 'value1'], ['list1', 'a', 'b']]), \
+		xlyaml.Collection([['key1', 'value2'], ['list1', None], \
+			[None, 'c']]) \
+		]
+
+	assert xlyaml.dumpCollections(collections) == \
+		''.join([c.buildOutput() for c in collections])
+
+def test_interner_shares_repeated_blocks_as_yaml_anchors():
+	rows = [ \
+		['ntp', 'name', 'ip'], \
+		[None, 'ntp1', '10.0.0.1'], \
+		['vlans', None, None], \
+		[None, '10', None], \
+		[None, '20', None] \
+		]
+	interner = xlyaml.Interner()
+	collections = [xlyaml.Collection([['hostname', name]] + rows, interner) \
+		for name in ['sw1', 'sw2', 'sw3']]
+	first, second = [c.collection[0] for c in collections[:2]]
+	text = xlyaml.dumpCollections(collections)
+
+	assert first['ntp'] is second['ntp']
+	assert first['vlans'] is second['vlans']
+	assert text.count('&id') == 2
+	assert text.count('*id') == 4
+	assert yaml.safe_load(text) == [xlyaml.Collection( \
+		[['hostname', name]] + rows).collection[0] \
+		for name in ['sw1', 'sw2', 'sw3']]
+	assert interner.intern([1, '1', True]) is not interner.intern(['1', 1, 1])
@@ -0,0 +1,362 @@
+import csv
+import pytest
+import yaml
+from openpyxl import Workbook, load_workbook
+import xlyaml
+
+def build_workbook(path, rows):
+	wb = Workbook()
+	ws = wb.active
+	ws.title = 'sheet1'
+	for row in rows:
+		ws.append(row)
+	wb.save(path)
+
+LIST_ROWS = [ \
+	['key1', 'value1', None, None], \
+	['list1', None, None, None], \
+	[None, 'l1_item1', None, None], \
+	[None, 'l1_item2', None, None], \
+	[None, None, None, None], \
+	['key1', 'value2', None, None], \
+	['dict1', 'd1_key1', 'd1_key2', 'd1_key3'], \
+	[None, 'd1_k1_v1', 'd1_k2_v1', 'd1_k3_v1'] \
+	]
+
+TABLE_ROWS = [ \
+	['name', 'vlan', 'ip'], \
+	['sw1', 10, '10.0.0.1'], \
+	['sw2', 20, None] \
+	]
+
+def test_sheet_class_streaming_matches_full_parse_list(tmpdir):
+	path = str(tmpdir.join('list.xlsx'))
+	build_workbook(path, LIST_ROWS)
+	full = xlyaml.Sheet(load_workbook(path)['sheet1'])
+	streamed = xlyaml.Sheet(load_workbook(path, read_only=True)['sheet1'], \
+		streaming=True)
+
+	assert list(streamed.getCollections()) == full.getCollections()
+	assert len(full.getCollections()) == 2
+
+def test_sheet_class_trims_rows_once(tmpdir):
+	path = str(tmpdir.join('list.xlsx'))
+	build_workbook(path, LIST_ROWS)
+	objects = xlyaml.Sheet(load_workbook(path)['sheet1']).getCollections()
+
+	assert objects[0][2] == xlyaml.Row(1, ('l1_item1',))
+	assert objects[1][1] == \
+		xlyaml.Row(0, ('dict1', 'd1_key1', 'd1_key2', 'd1_key3'))
+	assert [xlyaml.Collection(obj).collection for obj in objects] == \
+		[xlyaml.Collection(rows).collection for rows in \
+		[LIST_ROWS[:4], LIST_ROWS[5:]]]
+
+def test_sheet_class_streaming_matches_full_parse_table(tmpdir):
+	path = str(tmpdir.join('table.xlsx'))
+	build_workbook(path, TABLE_ROWS)
+	full = xlyaml.Sheet(load_workbook(path)['sheet1'], sourceformat='table')
+	streamed = xlyaml.Sheet(load_workbook(path, read_only=True)['sheet1'], \
+		sourceformat='table', streaming=True)
+
+	assert list(streamed.getCollections()) == full.getCollections()
+	assert full.getCollections()[1] == [xlyaml.Row(0, ('name', 'sw2')), \
+		xlyaml.Row(0, ('vlan', '20')), xlyaml.Row(0, ('ip', 'None'))]
+
+def test_xlyaml_streaming_output_matches_full_output(tmpdir):
+	path = str(tmpdir.join('list.xlsx'))
+	build_workbook(path, LIST_ROWS)
+	with tmpdir.as_cwd():
+		xlyaml.xlyaml(path)
+		full = tmpdir.join('sheet1.yml').read()
+		xlyaml.xlyaml(path, streaming=True)
+		streamed = tmpdir.join('sheet1.yml').read()
+
+	assert streamed == full
+
+def test_xlyaml_parallel_output_matches_serial_output(tmpdir):
+	path = str(tmpdir.join('multi.xlsx'))
+	wb = Workbook()
+	for idx in range(3):
+		ws = wb.create_sheet(title='sheet%d' % idx)
+		for row in LIST_ROWS:
+			ws.append(row)
+	wb.remove_sheet(wb['Sheet'])
+	wb.save(path)
+	names = ['sheet%d.yml' % idx for idx in range(3)]
+	with tmpdir.as_cwd():
+		xlyaml.xlyaml(path)
+		serial = [tmpdir.join(name).read() for name in names]
+		for name in names:
+			tmpdir.join(name).remove()
+		xlyaml.xlyaml(path, jobs=2)
+		parallel = [tmpdir.join(name).read() for name in names]
+
+	assert parallel == serial
+
+def test_xlyaml_incremental_skips_unchanged_sheets(tmpdir):
+	path = str(tmpdir.join('multi.xlsx'))
+	wb = Workbook()
+	wb.active.title = 'sheet0'
+	wb.create_sheet(title='sheet1')
+	for row in LIST_ROWS:
+		wb['sheet0'].append(row)
+		wb['sheet1'].append(row)
+	wb.save(path)
+	with tmpdir.as_cwd():
+		xlyaml.xlyaml(path, incremental=True)
+		tmpdir.join('sheet0.yml').setmtime(1000000000)
+		tmpdir.join('sheet1.yml').setmtime(1000000000)
+		xlyaml.xlyaml(path, incremental=True)
+		assert tmpdir.join('sheet0.yml').mtime() == 1000000000
+		assert tmpdir.join('sheet1.yml').mtime() == 1000000000
+
+		wb['sheet1']['B1'] = 'changed'
+		wb.save(path)
+		xlyaml.xlyaml(path, incremental=True)
+		assert tmpdir.join('sheet0.yml').mtime() == 1000000000
+		assert tmpdir.join('sheet1.yml').mtime() != 1000000000
+		assert 'changed' in tmpdir.join('sheet1.yml').read()
+
+		xlyaml.xlyaml(path, incremental=True, sourceformat='table')
+		assert tmpdir.join('sheet0.yml').mtime() != 1000000000
+
+class Cell():
+	def __init__(self, value):
+		self.value = value
+
+class CountingSheet():
+	title = 'hosts'
+
+	def __init__(self, objects):
+		self.objects = objects
+		self.read = 0
+
+	def iter_rows(self):
+		for idx in range(self.objects):
+			self.read += 1
+			yield [Cell('name'), Cell('host%d' % idx)]
+			yield [Cell(None), Cell(None)]
+
+def test_sheet_chunks_start_before_sheet_is_read(tmpdir):
+	ws = CountingSheet(10 * xlyaml.DUMP_BATCH)
+	sheet = xlyaml.Sheet(ws, streaming=True)
+	chunks = xlyaml.sheetChunks('hosts', sheet.iterCollections())
+	text = [next(chunks), next(chunks)]
+	assert 'host0' in text[1]
+	assert ws.read <= xlyaml.DUMP_BATCH + 1
+	text.extend(chunks)
+
+	full = xlyaml.Sheet(CountingSheet(10 * xlyaml.DUMP_BATCH))
+	assert ''.join(text) == ''.join(xlyaml.sheetChunks('hosts', \
+		list(full.iterCollections()), streaming=True))
+
+def test_xlyaml_outputs_rewrites_only_changed_files(tmpdir):
+	path = str(tmpdir.join('multi.xlsx'))
+	wb = Workbook()
+	wb.active.title = 'sheet0'
+	wb.create_sheet(title='sheet1')
+	for row in LIST_ROWS:
+		wb['sheet0'].append(row)
+		wb['sheet1'].append(row)
+	wb.save(path)
+	with tmpdir.as_cwd():
+		xlyaml.xlyaml(path, outputs='outputs.json')
+		expected = tmpdir.join('sheet0.yml').read()
+		tmpdir.join('sheet0.yml').setmtime(1000000000)
+		tmpdir.join('sheet1.yml').setmtime(1000000000)
+
+		wb['sheet1']['B1'] = 'changed'
+		wb.save(path)
+		xlyaml.xlyaml(path, jobs=2, outputs='outputs.json')
+		assert tmpdir.join('sheet0.yml').mtime() == 1000000000
+		assert tmpdir.join('sheet0.yml').read() == expected
+		assert 'changed' in tmpdir.join('sheet1.yml').read()
+
+		wb.remove_sheet(wb['sheet1'])
+		wb.save(path)
+		xlyaml.xlyaml(path, outputs='outputs.json')
+		assert not tmpdir.join('sheet1.yml').exists()
+		assert tmpdir.join('sheet0.yml').mtime() == 1000000000
+
+def test_xlyaml_converts_selected_sheets_and_range(tmpdir):
+	path = str(tmpdir.join('multi.xlsx'))
+	wb = Workbook()
+	wb.active.title = 'sheet0'
+	wb.create_sheet(title='sheet1')
+	for row in LIST_ROWS:
+		wb['sheet0'].append(row)
+		wb['sheet1'].append(row)
+	wb.save(path)
+	build_workbook(str(tmpdir.join('head.xlsx')), LIST_ROWS[:4])
+	with tmpdir.as_cwd():
+		xlyaml.xlyaml('head.xlsx')
+		expected = tmpdir.join('sheet1.yml').read()
+		tmpdir.join('sheet1.yml').remove()
+		xlyaml.xlyaml(path, sheets=['sheet1'], cellrange='A1:D4')
+		assert not tmpdir.join('sheet0.yml').exists()
+		assert tmpdir.join('sheet1.yml').read() == expected
+
+		csvdir = tmpdir.mkdir('csv')
+		write_csv(str(csvdir.join('sheet1.csv')), LIST_ROWS)
+		xlyaml.xlyaml(str(csvdir), cellrange='A1:D4')
+		assert tmpdir.join('sheet1.yml').read() == expected
+
+		with pytest.raises(ValueError):
+			xlyaml.xlyaml(path, sheets=['missing'])
+
+def test_workbook_index_is_reused_until_workbook_changes(tmpdir, monkeypatch):
+	path = str(tmpdir.join('multi.xlsx'))
+	wb = Workbook()
+	wb.active.title = 'sheet0'
+	wb.create_sheet(title='sheet1')
+	for row in LIST_ROWS:
+		wb['sheet0'].append(row)
+	wb.save(path)
+	index = str(tmpdir.join('index.json'))
+	first = xlyaml.workbookIndex(path, index)
+	assert first['titles'] == ['sheet0', 'sheet1']
+	assert first['sheets']['sheet0']['dimensions'] == 'A1:D8'
+
+	def fail(*args, **kwargs):
+		raise AssertionError('workbook was read again')
+	monkeypatch.setattr(xlyaml, 'openWorkbook', fail)
+	assert xlyaml.workbookIndex(path, index) == first
+	monkeypatch.undo()
+
+	wb['sheet1'].append(['key1', 'value1'])
+	wb.save(path)
+	second = xlyaml.workbookIndex(path, index, ['sheet1'])
+	assert second['sheets'].keys() == ['sheet1']
+	assert second['sheets']['sheet1']['dimensions'] == 'A1:B1'
+
+def write_csv(path, rows, delimiter=','):
+	with open(path, 'wb') as f:
+		writer = csv.writer(f, delimiter=delimiter)
+		for row in rows:
+			writer.writerow(['' if value is None else value for value in row])
+
+def test_xlyaml_csv_output_matches_workbook_output(tmpdir):
+	path = str(tmpdir.join('list.xlsx'))
+	build_workbook(path, LIST_ROWS)
+	csvdir = tmpdir.mkdir('csv')
+	write_csv(str(csvdir.join('sheet1.csv')), LIST_ROWS)
+	write_csv(str(csvdir.join('sheet2.tsv')), TABLE_ROWS, '\t')
+	with tmpdir.as_cwd():
+		xlyaml.xlyaml(path)
+		expected = tmpdir.join('sheet1.yml').read()
+		tmpdir.join('sheet1.yml').remove()
+		xlyaml.xlyaml(str(csvdir))
+
+		assert tmpdir.join('sheet1.yml').read() == expected
+		assert tmpdir.join('sheet2.yml').check()
+
+def test_sheet_class_csv_table_matches_workbook_table(tmpdir):
+	path = str(tmpdir.join('table.xlsx'))
+	build_workbook(path, TABLE_ROWS)
+	write_csv(str(tmpdir.join('table.csv')), TABLE_ROWS[:2] + [['sw2', 20]])
+	full = xlyaml.Sheet(load_workbook(path)['sheet1'], sourceformat='table')
+	text = xlyaml.Sheet(xlyaml.CsvSheet(str(tmpdir.join('table.csv'))), \
+		sourceformat='table')
+
+	assert text.getCollections() == full.getCollections()
+
+def test_sheet_class_typed_table_keeps_native_values(tmpdir):
+	path = str(tmpdir.join('table.xlsx'))
+	build_workbook(path, TABLE_ROWS)
+	write_csv(str(tmpdir.join('table.csv')), TABLE_ROWS)
+	ws = load_workbook(path)['sheet1']
+	typed = [xlyaml.Collection(obj).collection[0] for obj in \
+		xlyaml.Sheet(ws, sourceformat='table', types={}).getCollections()]
+	text = xlyaml.Sheet(xlyaml.CsvSheet(str(tmpdir.join('table.csv'))), \
+		sourceformat='table', types={'vlan': 'str'})
+	plain = xlyaml.Sheet(ws, sourceformat='table')
+
+	assert typed[1] == {'name': 'sw2', 'vlan': 20, 'ip': None}
+	assert xlyaml.Collection(text.getCollections()[0]).collection[0] == \
+		{'name': 'sw1', 'vlan': '10', 'ip': '10.0.0.1'}
+	assert xlyaml.Collection(plain.getCollections()[1]).collection[0] == \
+		{'name': 'sw2', 'vlan': '20', 'ip': 'None'}
+
+def test_sheet_class_typed_list_converts_declared_keys(tmpdir):
+	path = str(tmpdir.join('list.csv'))
+	write_csv(path, [ \
+		['mtu', '9000', None], \
+		['enabled', 'yes', None], \
+		['serial', '0042', None], \
+		['ports', None, None], \
+		[None, '1', None], \
+		[None, '2', None], \
+		['vlans', 'id', 'name'], \
+		[None, '10', '20'] \
+		])
+	sheet = xlyaml.Sheet(xlyaml.CsvSheet(path), \
+		types={'name': 'str', 'ports': 'float', 'enabled': 'bool'})
+
+	assert xlyaml.Collection(sheet.getCollections()[0]).collection[0] == \
+		{'mtu': 9000, 'enabled': True, 'serial': '0042', \
+		'ports': [1.0, 2.0], 'vlans': [{'id': 10, 'name': '20'}]}
+	with pytest.raises(ValueError):
+		xlyaml.Sheet(xlyaml.CsvSheet(path), types={'enabled': 'int'})
+
+def test_sheet_class_typed_date_rejects_numbers(tmpdir):
+	path = str(tmpdir.join('table.xlsx'))
+	build_workbook(path, TABLE_ROWS)
+	ws = load_workbook(path)['sheet1']
+
+	with pytest.raises(ValueError) as excinfo:
+		xlyaml.Sheet(ws, sourceformat='table', types={'vlan': 'date'}) \
+			.getCollections()
+	assert 'vlan' in str(excinfo.value)
+
+def test_xlyaml_failed_dump_leaves_no_output_file(tmpdir):
+	path = str(tmpdir.join('table.csv'))
+	write_csv(path, [['name', 'born'], ['sw1', '2016-01-02']])
+	with tmpdir.as_cwd():
+		with pytest.raises(ValueError):
+			xlyaml.xlyaml(path, sourceformat='table', format='marshal', \
+				types={'born': 'date'})
+
+	assert tmpdir.listdir(lambda p: p.basename != 'table.csv') == []
+
+def test_xlyaml_anchors_span_the_whole_sheet(tmpdir):
+	path = str(tmpdir.join('list.xlsx'))
+	rows = []
+	for idx in range(2 * xlyaml.DUMP_BATCH):
+		rows.extend([['name', 'host%d' % idx], ['vlans', None], \
+			[None, '10'], [None, '20'], [None, None]])
+	build_workbook(path, rows)
+	with tmpdir.as_cwd():
+		xlyaml.xlyaml(path, streaming=True)
+		plain = tmpdir.join('sheet1.yml').read()
+		xlyaml.xlyaml(path, streaming=True, anchors=True)
+		text = tmpdir.join('sheet1.yml').read()
+
+	assert text.count('&id') == 1
+	assert len(text) < len(plain)
+	assert yaml.safe_load(text) == yaml.safe_load(plain)
+
+def test_sheet_class_typed_list_keeps_keys_as_text(tmpdir):
+	path = str(tmpdir.join('list.csv'))
+	write_csv(path, [ \
+		['on', 'x', None], \
+		['no', '10', None], \
+		['10', 'yes', None], \
+		['vlans', 'on', 'id'], \
+		[None, 'yes', '5'] \
+		])
+	sheet = xlyaml.Sheet(xlyaml.CsvSheet(path), types={})
+
+	assert xlyaml.Collection(sheet.getCollections()[0]).collection[0] == \
+		{'on': 'x', 'no': 10, '10': True, 'vlans': [{'on': True, 'id': 5}]}
+
+def test_sheet_class_csv_table_reads_rows_longer_than_header(tmpdir):
+	path = str(tmpdir.join('table.csv'))
+	tmpdir.join('table.csv').write('name,vlan\nsw1,10,extra\nsw2,20\n')
+	for types in [None, {}]:
+		sheet = xlyaml.Sheet(xlyaml.CsvSheet(path), sourceformat='table', \
+			types=types)
+		collections = [xlyaml.Collection(obj).collection[0] \
+			for obj in sheet.getCollections()]
+
+		assert collections[0]['None'] == 'extra'
+		assert collections[1]['name'] == 'sw2'
@@ -5,12 +5,60 @@ import logging
 import sys
 import string
 import random
+import glob
+import json
+import hashlib
+import marshal
 import argparse
+import itertools
 
-import yaml
-import jinja2
+from outputs import OutputManifest, OutputWriter
+import profiling
+from workers import worker_pool
 
-logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+# Name of the render variable that carries the multi-file cookie
+COOKIE_VAR = '_textbuilder_cookie'
+
+# Separates a template path from the fileid in multi-file template names
+FILEID_SEP = '#fileid='
+
+# Long-lived jinja2 environments, keyed by bytecode cache directory
+_environments = {}
+
+# Name of the on-disk cache entry of a parsed varfile
+VARCACHE_PATTERN = '__varfile_%s.cache'
+
+# Largest total size, in bytes, of cached varfiles; least recently used
+# entries are evicted beyond it
+VARCACHE_SIZE = 256 * 1024 * 1024
+
+# Loaded jobs, templates and variables of the running batch, shared with
+# forked worker processes
+_batch = None
+
+# Template, context and shard bounds of the running sharded render,
+# shared with forked worker processes
+_sharded = None
+
+# Default file recording the inputs and outputs of each job, used to
+# skip jobs whose inputs are unchanged
+STATEFILE = '.textbuilder-state.json'
+
+def setup_logging(level=logging.INFO):
+    '''
+    Sends log messages at level and above to the console
+    '''
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s',
+        level=level)
+    logging.getLogger().setLevel(level)
+
+def yaml_loader():
+    '''
+    Returns the libyaml-backed safe loader if PyYAML was built with it,
+    or the pure-Python one
+    '''
+    import yaml
+    return getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
 
 def id_generator(size=12, chars=string.ascii_uppercase + string.digits):
     """
@@ -21,7 +69,192 @@ def id_generator(size=12, chars=string.ascii_uppercase + string.digits):
     """
     return ''.join(random.choice(chars) for _ in range(size))
 
-def textbuilder(temp=None, varfile=None, outfile='results.txt', fileid=None):
+def split_stream(chunks, separator):
+    '''
+    Yields the pieces of a stream of text chunks split on separator,
+    holding no more than one piece in memory at a time
+    '''
+    # Characters at the end of a chunk that could start a separator
+    keep = len(separator) - 1
+    piece = []
+    carry = u''
+    for chunk in chunks:
+        parts = (carry + chunk).split(separator)
+        for part in parts[:-1]:
+            piece.append(part)
+            yield u''.join(piece)
+            piece = []
+        cut = max(len(parts[-1]) - keep, 0)
+        piece.append(parts[-1][:cut])
+        carry = parts[-1][cut:]
+    piece.append(carry)
+    yield u''.join(piece)
+
+def iter_files(pieces):
+    '''
+    Yields (filename, text) pairs from the pieces of a multi-file render
+    split on its cookie
+    '''
+    pieces = iter(pieces)
+    first = next(pieces, None)
+    # The first element may be a newline left over from initial for loop
+    if first is not None and first != '\n':
+        pieces = itertools.chain([first], pieces)
+    # Names and data alternate, starting with a name
+    for name in pieces:
+        text = next(pieces, None)
+        if text is None:
+            logging.warning('No text rendered for %s; skipping', name)
+            break
+        # Assume output extension is .txt for now
+        yield name + '.txt', text
+
+def template_source(template):
+    '''
+    Returns the source of a template loaded by file path, as returned by
+    the get_source() method of jinja2 loaders
+    
+    A name of the form '<path>#fileid=<fileid>' loads the template with
+    the multi-file cookie inserted after its first line. The cookie only
+    references COOKIE_VAR, so the source stays the same from one run to
+    the next and can be served from the bytecode cache.
+    
+    :rtype: tuple of (source, filename, uptodate function)
+    '''
+    path, sep, fileid = template.partition(FILEID_SEP)
+    try:
+        with open(path, 'r') as f:
+            if fileid:
+                splitter = []
+                # Insert the first line of the template
+                splitter.append(f.readline())
+                # Insert the cookie
+                splitter.append('{{ ' + COOKIE_VAR + ' }}{{ ' + fileid + \
+                    ' }}{{ ' + COOKIE_VAR + ' }}')
+                # Insert the remainder of the template
+                splitter.append(f.read())
+                contents = ''.join(splitter)
+            else:
+                contents = f.read()
+    except IOError:
+        import jinja2
+        raise jinja2.TemplateNotFound(template)
+    contents = contents.decode('utf-8')
+
+    mtime = os.path.getmtime(path)
+
+    def uptodate():
+        try:
+            return os.path.getmtime(path) == mtime
+        except OSError:
+            return False
+    # jinja2 caches compiled templates by filename, so the cookie
+    # variant of a template needs a filename of its own
+    return contents, os.path.abspath(path) + sep + fileid, uptodate
+
+def get_environment(cachedir=None):
+    '''
+    Returns the long-lived jinja2 environment for cachedir
+
+    Compiled templates are kept in memory by the environment and on
+    disk by a bytecode cache in cachedir, or in the system temporary
+    directory if cachedir is None.
+    '''
+    if cachedir not in _environments:
+        import jinja2
+
+        class TemplateLoader(jinja2.BaseLoader):
+            '''
+            Loads templates by file path; see template_source
+            
+            Defined here so that jinja2 is only imported once a template
+            is loaded.
+            '''
+            def get_source(self, environment, template):
+                return template_source(template)
+
+        logging.debug('Creating jinja2 environment, cache dir %s', cachedir)
+        _environments[cachedir] = jinja2.Environment( \
+            loader=TemplateLoader(),
+            bytecode_cache=jinja2.FileSystemBytecodeCache(cachedir))
+    return _environments[cachedir]
+
+def load_cached_vars(varfile, cachedir=None, maxsize=VARCACHE_SIZE):
+    '''
+    Returns the variables of a YAML varfile, parsing it only if the
+    varfile cache holds no entry matching its path, size, mtime and
+    content hash
+    
+    Entries are kept in the bytecode cache directory of cachedir; see
+    get_environment.
+    '''
+    path = os.path.abspath(varfile)
+    with open(path, 'rb') as f:
+        content = f.read()
+    st = os.stat(path)
+    key = (path, st.st_size, st.st_mtime, hashlib.sha1(content).hexdigest())
+    
+    directory = get_environment(cachedir).bytecode_cache.directory
+    if isinstance(path, unicode):
+        name = path.encode('utf-8')
+    else:
+        name = path
+    entry = os.path.join(directory,
+        VARCACHE_PATTERN % hashlib.sha1(name).hexdigest())
+    try:
+        with open(entry, 'rb') as f:
+            cached_key, vars = marshal.load(f)
+        if tuple(cached_key) == key:
+            # Mark the entry as recently used
+            os.utime(entry, None)
+            logging.info('Loaded cached variables for %s', varfile)
+            return vars
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        pass
+    
+    import yaml
+    with profiling.phase('yaml_load', varfile):
+        vars = yaml.load(content, Loader=yaml_loader())
+    try:
+        data = marshal.dumps((key, vars), 2)
+    except ValueError:
+        # e.g. dates, which marshal can't represent
+        logging.debug('Variables of %s cannot be cached', varfile)
+        return vars
+    # Write to a temporary file first so readers never see half an entry
+    tmpname = '%s.%d.tmp' % (entry, os.getpid())
+    with open(tmpname, 'wb') as f:
+        f.write(data)
+    os.rename(tmpname, entry)
+    evict_varcache(directory, maxsize)
+    
+    return vars
+
+def evict_varcache(directory, maxsize=VARCACHE_SIZE):
+    '''
+    Removes the least recently used varfile cache entries in directory
+    until their total size is no more than maxsize bytes
+    '''
+    entries = []
+    for entry in glob.glob(os.path.join(directory, VARCACHE_PATTERN % '*')):
+        try:
+            st = os.stat(entry)
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, entry))
+    total = sum(size for mtime, size, entry in entries)
+    for mtime, size, entry in sorted(entries):
+        if total <= maxsize:
+            break
+        logging.debug('Evicting cached variables %s', entry)
+        try:
+            os.remove(entry)
+        except OSError:
+            pass
+        total -= size
+
+def textbuilder(temp=None, varfile=None, outfile='results.txt', fileid=None,
+        cachedir=None, stream=False, outputs=None, writers=1, shards=1):
     '''
     Returns string containing text of templates
     Optionally outputs to file 
@@ -45,54 +278,128 @@ def textbuilder(temp=None, varfile=None, outfile='results.txt', fileid=None):
             host.id .
     :type fileid: String
     
-    :rtype: string
+    :param cachedir: Directory holding compiled templates; defaults to
+            the system temporary directory
+    :type cachedir: String, containing directory name
+    
+    :param stream: If True, render the template incrementally and write
+            each output file as soon as its text is complete. The
+            rendered text is not kept; the list of files written is
+            returned instead.
+    :type stream: Boolean
+    
+    :param outputs: Output manifest; if set, files whose content is
+            unchanged since the last run are not rewritten, and files
+            no longer rendered are removed. See outputs.OutputManifest
+    :type outputs: String, containing filename
+    
+    :param writers: Number of threads writing multi-file output, so that
+            writing overlaps rendering; 1 writes each file before the
+            next is rendered
+    :type writers: Integer
+    
+    :param shards: Number of processes rendering multi-file output, each
+            a share of the items of the top-level loop; 0 uses one per
+            CPU. The output files are the same as with 1. If more than
+            1, the list of files written is returned as if stream were
+            set; see render_shards
+    :type shards: Integer
+    
+    :rtype: string, or list of filenames if stream or shards is set
     '''
     
     logging.debug('Running textbuilder...')
-    result = None
     
-    # If fileid is set, then outfile will not be used
-    if fileid:
-        outfile = None
+    the_template = load_template(temp, fileid, cachedir)
+    varref, vars = load_varfile(varfile, cachedir)
     
-    # Generate a cookie to identify where to separate docs if the function
-    # needs to generate multiple output files
+    if not outputs:
+        return build_output(the_template, {varref: vars}, outfile, fileid,
+            stream, writers=writers, shards=shards)
+    
+    manifest = OutputManifest(outputs)
+    job = {'template': temp, 'varfile': varfile}
     if fileid:
-        logging.info('Generating random ID for multi-file output')
-        random_id = id_generator()
-        logging.debug('Random ID is %s', random_id)
-        logging.info('Creating cookie for multi-file output')
-        cookie = random_id + '{{ ' + fileid + ' }}' + random_id
-        logging.debug('Cookie is %s', cookie)
+        job['fileid'] = fileid
+    else:
+        job['outfile'] = outfile
+    result = build_output(the_template, {varref: vars}, outfile, fileid,
+        stream, manifest, job_key(job), writers, shards)
+    summary = manifest.save()
+    logging.info('%d files written, %d unchanged, %d removed',
+        len(summary['written']), len(summary['skipped']),
+        len(summary['removed']))
+    
+    return result
+
+def load_template(temp, fileid=None, cachedir=None):
+    '''
+    Returns the compiled template for temp, compiling it only if it is
+    not cached yet
+    
+    :param temp: Template file
+    :type temp: File, formatted for jinja2 processing
+    
+    :param fileid: Tag distinguishing multi-file output; see textbuilder
+    :type fileid: String
     
-    # Open template file
+    :param cachedir: Directory holding compiled templates
+    :type cachedir: String, containing directory name
+    
+    :rtype: jinja2.Template
+    '''
+    
+    import jinja2
+    
+    template_name = os.path.abspath(temp)
+    if fileid:
+        template_name += FILEID_SEP + fileid
     try:
-        tempfile = open(temp, 'r')
+        environment = get_environment(cachedir)
+        with profiling.phase('load_template', temp):
+            the_template = environment.get_template(template_name)
         logging.info('Opened template: %s', temp)
-        # Insert cookie into template if multiple output files needed
-        if fileid:
-            splitter = []
-            # Insert the first line of tempfile
-            splitter.append(tempfile.readline())
-            # Insert the cookie
-            splitter.append(cookie)
-            # Insert the remainder of tempfile
-            splitter.append(''.join(tempfile.readlines()))
-            template = ''.join(splitter)
-        else:
-            template = tempfile.read()
-        logging.debug('Template contents:\n%s', template)
-    except:
+    except jinja2.TemplateNotFound:
         logging.error('Failed to open template: %s', temp)
         print "\n"
         print "Failed to open template:", temp
         print "Please check filename and try again."
         print "\n"
         raise
-        
-    # Open variable file and load variables
+    
+    return the_template
+
+def load_varfile(varfile, cachedir=None):
+    '''
+    Returns the variable reference and the variables of varfile
+    
+    The variable reference is the filename stem, which should match
+    what users will put in their template files. Parsed YAML is cached
+    on disk; see load_cached_vars.
+    
+    :param varfile: File containing variables
+    :type varfile: File, formatted in YAML, or in JSON or Python marshal
+            format if named '.json' or '.marshal'
+    
+    :param cachedir: Directory holding compiled templates and variables
+    :type cachedir: String, containing directory name
+    
+    :rtype: tuple of (string, object)
+    '''
+    
+    # Open variable file and load variables in the format its
+    # extension names
+    ext = os.path.splitext(varfile)[1].lower()
     try:
-        vars = yaml.load(open(varfile, 'r'), Loader=yaml.Loader)
+        with profiling.phase('load_varfile', varfile):
+            if ext == '.json':
+                with open(varfile, 'r') as f:
+                    vars = json.load(f)
+            elif ext == '.marshal':
+                with open(varfile, 'rb') as f:
+                    vars = marshal.load(f)
+            else:
+                vars = load_cached_vars(varfile, cachedir)
         logging.info('Opened variable file: %s', varfile)
         logging.debug('Variable file contents:\n%s', vars)
     except:
@@ -103,41 +410,320 @@ def textbuilder(temp=None, varfile=None, outfile='results.txt', fileid=None):
         print "\n"
         raise    
     
-    # Set up variable reference, which should match what users will put
-    # in their template files
+    # Set up variable reference
     base = os.path.basename(varfile)
     varref = os.path.splitext(base)[0]
     logging.info('Variable reference is %s', varref)
     
-    the_template = jinja2.Template(template)
-    # Jinja2 doesn't allow keywords to be variables, so we have to build
-    # a string which will subsequently be evaluated in order to keep this
-    # as general as desired.
-    render_string = 'the_template.render('+varref+'=vars)'
-    rendered = eval(render_string)
+    return varref, vars
+
+def write_files(files, manifest=None, group=None, writers=1):
+    '''
+    Writes (filename, text) pairs as they are yielded; returns the list
+    of filenames
+    
+    :param manifest: If set, files are written through it, under group;
+            see outputs.OutputManifest
+    :type manifest: outputs.OutputManifest
+    
+    :param writers: Number of threads writing files; with more than one,
+            the text of each file must be a string, and files are
+            written while the next ones are produced. See
+            outputs.OutputWriter
+    :type writers: Integer
+    '''
+    
+    writer = None
+    if writers > 1:
+        writer = OutputWriter(writers, manifest=manifest)
+    names = []
+    try:
+        for fname, text in files:
+            if writer is not None:
+                writer.write(fname, text, group)
+            elif manifest is not None:
+                with profiling.phase('write', fname, exclusive=True):
+                    manifest.write(group, fname, text)
+            else:
+                logging.info('Writing file %s', fname)
+                with profiling.phase('write', fname, exclusive=True):
+                    with open(fname, 'w') as f:
+                        if isinstance(text, basestring):
+                            f.write(text)
+                        else:
+                            f.writelines(text)
+            names.append(fname)
+    except:
+        if writer is None:
+            raise
+        # Stop the writer threads without hiding the original error;
+        # failed writes have been logged already
+        exc_info = sys.exc_info()
+        try:
+            writer.close()
+        except IOError:
+            pass
+        raise exc_info[0], exc_info[1], exc_info[2]
+    if writer is not None:
+        writer.close()
+    
+    return names
+
+def loop_collection(the_template):
+    '''
+    Returns the keys leading from the render context to the collection
+    the top-level for loop of a template iterates over; e.g.
+    ['switches', 'hosts'] for {% for host in switches.hosts %}
+    
+    The loop must open on the first line, as for multi-file output.
+    None is returned if there is no such loop, if it iterates over
+    anything but variables, attributes and constant indexes, or if its
+    items can't be rendered apart from each other because the loop is
+    recursive, filtered or its body uses the loop variable. Since each
+    shard sees only its share of the collection, None is also returned
+    if the template, or a template it includes, imports or extends,
+    uses the collection's variable anywhere but in the loop's iterable,
+    e.g. {{ switches.hosts|length }} in the body, or if the templates it
+    references can't all be found; see template_dependencies.
+    
+    :rtype: list, or None
+    '''
+    
+    from jinja2 import nodes, TemplateNotFound
+    
+    environment = the_template.environment
+    path = the_template.name.partition(FILEID_SEP)[0]
+    source = environment.loader.get_source(environment, path)[0]
+    tree = environment.parse(source)
+    loop = None
+    for node in tree.body:
+        if not isinstance(node, nodes.Output):
+            loop = node
+            break
+    if not isinstance(loop, nodes.For) or loop.lineno != 1:
+        return None
+    if loop.recursive or loop.test is not None or \
+            any(name.name == 'loop' for name in loop.find_all(nodes.Name)):
+        return None
+    
+    keys = []
+    node = loop.iter
+    while not isinstance(node, nodes.Name):
+        if isinstance(node, nodes.Getattr):
+            keys.append(node.attr)
+        elif isinstance(node, nodes.Getitem) and \
+                isinstance(node.arg, nodes.Const):
+            keys.append(node.arg.value)
+        else:
+            return None
+        node = node.node
+    keys.append(node.name)
+    if sum(1 for name in tree.find_all(nodes.Name) \
+            if name.name == node.name) > 1:
+        return None
+    
+    # Included and imported templates see the whole context, and the
+    # loop variable, too
+    cachedir = None
+    for key, cached in _environments.items():
+        if cached is environment:
+            cachedir = key
+    try:
+        deps = template_dependencies(path, cachedir)
+        if deps is None:
+            return None
+        for other in deps[1] - set([os.path.abspath(path)]):
+            variables = template_dependencies(other, cachedir)[0]
+            if node.name in variables or 'loop' in variables:
+                logging.debug('%s uses %s or loop', other, node.name)
+                return None
+    except TemplateNotFound:
+        return None
+    
+    return keys[::-1]
+
+def _replace_collection(context, keys, items):
+    '''
+    Returns a copy of context in which the collection at keys is items;
+    containers on the way are copied, so context isn't changed
+    '''
+    context = dict(context)
+    container = context
+    for key in keys[:-1]:
+        container[key] = type(container[key])(container[key])
+        container = container[key]
+    container[keys[-1]] = items
+    
+    return context
+
+def _render_shard(idx):
+    '''
+    Renders and writes shard idx of the running sharded render; returns
+    the files written and, if there is an output manifest, what it
+    recorded
+    '''
+    
+    the_template, context, keys, items, bounds, manifest, group, writers = \
+        _sharded
+    start, stop = bounds[idx]
+    last = stop == len(items)
+    # A shard also renders the first item of the next shard, and drops
+    # its file; the text between the two items then ends the shard's
+    # last file, exactly as in a serial render
+    if not last:
+        stop += 1
+    context = _replace_collection(context, keys, items[start:stop])
+    chunks = profiling.timed('render', the_template.generate(context),
+        the_template.name)
+    files = iter_files(split_stream(chunks, context[COOKIE_VAR]))
+    if not last:
+        files = itertools.islice(files, stop - start - 1)
+    with profiling.phase('shard', idx):
+        names = write_files(files, manifest, group, writers)
+    
+    if manifest is None:
+        return names, None
+    return names, manifest.export(group)
+
+def render_shards(the_template, context, shards, manifest=None, group=None,
+        writers=1):
+    '''
+    Renders multi-file output in shards worker processes, each rendering
+    and writing the files of a share of the template's top-level loop;
+    see loop_collection. File names and contents are those of a serial
+    render. context must hold the multi-file cookie. Each process writes
+    its files with writers threads; see write_files.
+    
+    Returns the list of files written, or None if the template can't
+    be sharded
+    '''
+    
+    import multiprocessing
+    
+    global _sharded
+    
+    keys = loop_collection(the_template)
+    if keys is None:
+        logging.warning('%s does not start with a loop that can be '
+            'sharded; rendering in one process', the_template.name)
+        return None
+    items = context
+    try:
+        for key in keys:
+            items = items[key]
+        items = list(items)
+    except (KeyError, IndexError, TypeError):
+        logging.warning('Loop collection %s not found; rendering in one '
+            'process', '.'.join(str(key) for key in keys))
+        return None
+    
+    if not shards:
+        shards = multiprocessing.cpu_count()
+    shards = max(min(shards, len(items)), 1)
+    size, extra = divmod(len(items), shards)
+    bounds = []
+    start = 0
+    for idx in range(shards):
+        stop = start + size + (1 if idx < extra else 0)
+        bounds.append((start, stop))
+        start = stop
+    logging.info('Rendering %d items of %s in %d shards', len(items),
+        '.'.join(str(key) for key in keys), shards)
+    
+    _sharded = (the_template, context, keys, items, bounds, manifest, group,
+        writers)
+    try:
+        if shards > 1:
+            with worker_pool(shards) as pool:
+                results = pool.map(_render_shard, range(shards), chunksize=1)
+        else:
+            results = [_render_shard(0)]
+    finally:
+        _sharded = None
+    
+    names = []
+    for files, exported in results:
+        names.extend(files)
+        if exported is not None:
+            manifest.merge(group, exported)
+    
+    return names
+
+def build_output(the_template, context, outfile='results.txt',
+        fileid=None, stream=False, manifest=None, group=None, writers=1,
+        shards=1):
+    '''
+    Renders a loaded template and writes the output file(s); arguments
+    and result are as for textbuilder
+    
+    :param context: Variables the template references, keyed by the
+            name used in the template; e.g. {varref: vars}
+    :type context: Dict
+    
+    :param manifest: If set, output files are written through it, under
+            group; see outputs.OutputManifest
+    :type manifest: outputs.OutputManifest
+    
+    :param writers: Number of threads writing multi-file output; see
+            write_files
+    :type writers: Integer
+    
+    :param shards: Number of processes rendering multi-file output, 0 for
+            one per CPU; see render_shards. The list of files written is
+            returned, as if stream were set
+    :type shards: Integer
+    '''
+    
+    result = None
+    
+    # If fileid is set, then outfile will not be used
+    if fileid:
+        outfile = None
+    
+    context = dict(context)
+    # Generate a cookie to identify where to separate docs if the function
+    # needs to generate multiple output files
+    if fileid:
+        logging.info('Generating random ID for multi-file output')
+        random_id = id_generator()
+        logging.debug('Random ID is %s', random_id)
+        context[COOKIE_VAR] = random_id
+    
+    if fileid and shards != 1:
+        result = render_shards(the_template, context, shards, manifest,
+            group, writers)
+        if result is not None:
+            return result
+        # The template can't be sharded; render it the usual way
+        stream = True
+    
+    if stream:
+        # Render one segment of text at a time; nothing is joined. The
+        # render is timed as the chunks are consumed
+        chunks = profiling.timed('render', the_template.generate(context),
+            the_template.name)
+        if fileid:
+            return write_files(iter_files(split_stream(chunks, random_id)),
+                manifest, group, writers)
+        return write_files([(outfile, chunks)], manifest, group)
+
+    with profiling.phase('render', the_template.name):
+        rendered = the_template.render(context)
     logging.debug('rendered: %s', str(rendered))
     
     # Write output file(s)
     # Write multiple files if fileid is set
     if fileid:
         # Split rendered string so we can strip the cookie out
-        rendered_split = rendered.split(random_id)
-        result_split = []
-        # The first element may be a newline left over from initial for loop
-        if rendered_split[0] == '\n':
-            del(rendered_split[0])
-        # Names should be even list items, and data should be odd
-        for idname in range(0, len(rendered_split), 2):
-            # Assume output extension is .txt for now
-            fname = rendered_split[idname] + '.txt'
-            logging.info('Writing file %s', fname)
-            with open(fname, 'w') as f:
-                f.write(rendered_split[idname + 1])
-            result_split.append(rendered_split[idname + 1])
+        files = list(iter_files(rendered.split(random_id)))
+        write_files(files, manifest, group, writers)
         # Prepare a single result, w/o cookies, to return
-        result = ''.join(result_split)
+        result = ''.join(text for fname, text in files)
     else:
         result = rendered
+        if manifest is not None:
+            manifest.write(group, outfile, result)
+            return result
         try:
             ofile = open(outfile, 'w')
             logging.info('Writing results to %s',ofile)
@@ -146,30 +732,369 @@ def textbuilder(temp=None, varfile=None, outfile='results.txt', fileid=None):
             logging.info('Closed output file %s',ofile)
         except:
             pass
-        
-    tempfile.close()
-    logging.info('Closed template: %s', temp)
     
     return result
 
+def template_dependencies(temp, cachedir=None, _seen=None):
+    '''
+    Returns the variables a template reads from its context and the
+    templates it is made of, found from its jinja2 syntax tree
+    
+    Included, imported and extended templates are followed, and their
+    variables count as the template's own. Template names are resolved
+    as template_source resolves them.
+    
+    :rtype: tuple of (set of variable names, set of absolute template
+            paths), or None if a template is referenced by an expression
+            and can't be known before rendering
+    '''
+    
+    from jinja2 import meta
+    
+    environment = get_environment(cachedir)
+    path = os.path.abspath(temp)
+    if _seen is None:
+        _seen = set()
+    variables = set()
+    templates = set([path])
+    if path in _seen:
+        return variables, templates
+    _seen.add(path)
+    
+    source = environment.loader.get_source(environment, path)[0]
+    ast = environment.parse(source)
+    variables.update(meta.find_undeclared_variables(ast))
+    for name in meta.find_referenced_templates(ast):
+        if name is None:
+            logging.info('%s references a template by expression', temp)
+            return None
+        deps = template_dependencies(name, cachedir, _seen)
+        if deps is None:
+            return None
+        variables.update(deps[0])
+        templates.update(deps[1])
+    
+    return variables, templates
+
+def job_inputs(job, cachedir=None):
+    '''
+    Returns the absolute paths of the files a job's output depends on:
+    its template, the templates that one is made of and, if the template
+    references its variable reference, its varfile
+    
+    :rtype: sorted list, or None if the inputs can't be known; see
+            template_dependencies
+    '''
+    
+    deps = template_dependencies(job['template'], cachedir)
+    if deps is None:
+        return None
+    variables, inputs = deps
+    varfile = job['varfile']
+    varref = os.path.splitext(os.path.basename(varfile))[0]
+    if varref in variables:
+        inputs = inputs | set([os.path.abspath(varfile)])
+    else:
+        logging.debug('%s does not reference %s', job['template'], varref)
+    
+    return sorted(inputs)
+
+def file_digest(path):
+    '''
+    Returns the SHA-1 hex digest of a file's contents, or None if it
+    can't be read
+    '''
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except IOError:
+        return None
+
+def job_key(job):
+    '''
+    Returns the key of a job in the state file
+    '''
+    return json.dumps(job, sort_keys=True)
+
+def load_state(statefile):
+    '''
+    Returns the job records of the last run that used statefile
+    '''
+    try:
+        with open(statefile, 'r') as f:
+            state = json.load(f)
+    except (IOError, ValueError):
+        logging.debug('No usable state file found at %s', statefile)
+        return {}
+    
+    return state.get('jobs', {})
+
+def save_state(statefile, records):
+    '''
+    Writes the job records of a run to statefile
+    '''
+    with open(statefile, 'w') as f:
+        json.dump({'jobs': records}, f, indent=2, sort_keys=True)
+    logging.debug('Wrote state file %s', statefile)
+
+def load_jobs(jobfile):
+    '''
+    Returns the list of jobs in a YAML job file
+    
+    Each job is a mapping with 'template' and 'varfile' keys, plus either
+    'outfile' or 'fileid'; e.g.:
+        - template: configtemp.txt
+          varfile: switches.yml
+          fileid: host.name
+        - template: vmtemplate.txt
+          varfile: vmhosts.yml
+          outfile: vms.txt
+    
+    :rtype: list of dicts
+    '''
+    
+    with open(jobfile, 'r') as f:
+        import yaml
+        jobs = yaml.load(f, Loader=yaml_loader()) or []
+    logging.info('Loaded %d jobs from %s', len(jobs), jobfile)
+    for job in jobs:
+        if 'template' not in job or 'varfile' not in job:
+            raise ValueError('Job needs a template and a varfile: %s' % job)
+        if 'outfile' not in job and 'fileid' not in job:
+            raise ValueError('Job needs an outfile or a fileid: %s' % job)
+    
+    return jobs
+
+def glob_jobs(temp_pattern, var_pattern, fileid=None):
+    '''
+    Returns a job for every template matching temp_pattern combined with
+    every varfile matching var_pattern
+    
+    Unless fileid is set, each job writes '<template>_<varref>.txt'.
+    
+    :rtype: list of dicts
+    '''
+    
+    jobs = []
+    for temp in sorted(glob.glob(temp_pattern)):
+        for varfile in sorted(glob.glob(var_pattern)):
+            job = {'template': temp, 'varfile': varfile}
+            if fileid:
+                job['fileid'] = fileid
+            else:
+                tempref = os.path.splitext(os.path.basename(temp))[0]
+                varref = os.path.splitext(os.path.basename(varfile))[0]
+                job['outfile'] = tempref + '_' + varref + '.txt'
+            jobs.append(job)
+    logging.info('Matched %d jobs', len(jobs))
+    
+    return jobs
+
+def _build_job(idx):
+    '''
+    Renders job idx of the running batch; returns the files written and,
+    if there is an output manifest, what it recorded for the job
+    '''
+    
+    jobs, templates, varfiles, manifest, writers = _batch
+    job = jobs[idx]
+    fileid = job.get('fileid')
+    the_template = templates[(job['template'], fileid)]
+    varref, vars = varfiles[job['varfile']]
+    
+    key = job_key(job)
+    with profiling.phase('job', key):
+        files = build_output(the_template, {varref: vars},
+            job.get('outfile'), fileid, True, manifest, key, writers)
+    if manifest is None:
+        return files, None
+    return files, manifest.export(key)
+
+def batchbuilder(jobs, processes=1, cachedir=None, changed=False,
+        statefile=STATEFILE, outputs=None, writers=1):
+    '''
+    Renders many templates with many varfiles in one process launch
+    
+    Each template and each varfile is loaded once, however many jobs use
+    it. Output is streamed to file as for textbuilder(stream=True).
+    
+    With changed set, a job is only rendered if one of its inputs (see
+    job_inputs) differs from the last run recorded in statefile, or one
+    of the files it wrote is missing; skipped jobs return no files.
+    
+    :param jobs: Jobs to render; see load_jobs and glob_jobs
+    :type jobs: List of dicts
+    
+    :param processes: Number of worker processes rendering jobs; 0 uses
+            one process per CPU
+    :type processes: Integer
+    
+    :param cachedir: Directory holding compiled templates
+    :type cachedir: String, containing directory name
+    
+    :param changed: If True, only render jobs whose inputs changed
+    :type changed: Boolean
+    
+    :param statefile: File recording the inputs and outputs of each job
+    :type statefile: String, containing filename
+    
+    :param outputs: Output manifest; see textbuilder
+    :type outputs: String, containing filename
+    
+    :param writers: Number of threads writing the files of each
+            multi-file job; see textbuilder
+    :type writers: Integer
+    
+    :rtype: list, containing the list of files written by each job
+    '''
+    
+    import multiprocessing
+    
+    global _batch
+    
+    manifest = None
+    if outputs:
+        manifest = OutputManifest(outputs)
+    
+    all_jobs = jobs
+    if changed:
+        previous = load_state(statefile)
+        records = {}
+        pending = []
+        for idx, job in enumerate(jobs):
+            key = job_key(job)
+            inputs = job_inputs(job, cachedir)
+            if inputs is not None:
+                records[key] = {'inputs': dict((path, file_digest(path)) \
+                    for path in inputs)}
+            record = previous.get(key, {})
+            if key in records and \
+                    record.get('inputs') == records[key]['inputs'] and \
+                    all(os.path.exists(f) for f in record.get('outputs', [])):
+                logging.info('Inputs of %s unchanged; skipping', job)
+                records[key]['outputs'] = record.get('outputs', [])
+                if manifest is not None:
+                    manifest.keep(key)
+            else:
+                pending.append(idx)
+        logging.info('%d of %d jobs changed since last run', len(pending),
+            len(jobs))
+        jobs = [jobs[idx] for idx in pending]
+    
+    templates = {}
+    varfiles = {}
+    for job in jobs:
+        key = (job['template'], job.get('fileid'))
+        if key not in templates:
+            templates[key] = load_template(key[0], key[1], cachedir)
+        if job['varfile'] not in varfiles:
+            varfiles[job['varfile']] = load_varfile(job['varfile'],
+                cachedir)
+    
+    if not processes:
+        processes = multiprocessing.cpu_count()
+    processes = min(processes, len(jobs))
+    
+    _batch = (jobs, templates, varfiles, manifest, writers)
+    try:
+        if processes > 1:
+            logging.info('Rendering %d jobs with %d processes',
+                len(jobs), processes)
+            with worker_pool(processes) as pool:
+                results = pool.map(_build_job, range(len(jobs)), chunksize=1)
+        else:
+            results = [_build_job(idx) for idx in range(len(jobs))]
+    finally:
+        _batch = None
+    
+    for idx, (files, exported) in enumerate(results):
+        if exported is not None:
+            manifest.merge(job_key(jobs[idx]), exported)
+    results = [files for files, exported in results]
+    if manifest is not None:
+        summary = manifest.save()
+        logging.info('%d files written, %d unchanged, %d removed',
+            len(summary['written']), len(summary['skipped']),
+            len(summary['removed']))
+    
+    if changed:
+        rendered = dict(zip(pending, results))
+        results = []
+        for idx, job in enumerate(all_jobs):
+            key = job_key(job)
+            files = rendered.get(idx, [])
+            if idx in rendered and key in records:
+                records[key]['outputs'] = files
+            results.append(files)
+        save_state(statefile, records)
+    
+    return results
+
 if __name__ == "__main__":
     """
     This runs if the program is called from the command line.
     """
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("template", type=str, 
-            help="Template file, format=Jinja2")
-    parser.add_argument("varfile", type=str, 
-            help="File containing variables")
+    parser.add_argument("template", type=str, nargs="?",
+            help="""Template file, format=Jinja2. With --batch, a glob
+            pattern matching template files""")
+    parser.add_argument("varfile", type=str, nargs="?",
+            help="""File containing variables, in YAML or, if named
+            '.json' or '.marshal', JSON or marshal format. With --batch,
+            a glob pattern matching variable files""")
     parser.add_argument("-o", "--outfile", type=str,
             help="""If outputting to a single file, this is the filename.
             If omitted, defaults to 'results.txt'""")
     parser.add_argument("-i", "--fileid", type=str,
             help="""If output to multi-file, this is the tag used to
             identify those files. Must refer to tag in variable file.""")
+    parser.add_argument("-c", "--cachedir", type=str,
+            help="""Directory holding compiled templates. If omitted,
+            defaults to the system temporary directory""")
+    parser.add_argument("-s", "--stream", action="store_true",
+            help="""Write each output file as soon as it is rendered
+            instead of rendering all output first""")
+    parser.add_argument("-j", "--jobfile", type=str,
+            help="""YAML file listing template, varfile and outfile or
+            fileid of each job to render in one batch""")
+    parser.add_argument("-b", "--batch", action="store_true",
+            help="""Render every template matching the template pattern
+            with every file matching the varfile pattern""")
+    parser.add_argument("-p", "--processes", type=int, default=1,
+            help="""Number of processes rendering batch jobs; 0 uses one
+            per CPU. If omitted, defaults to 1""")
+    parser.add_argument("-u", "--changed", action="store_true",
+            help="""Only render output whose template, included templates
+            or referenced variable file changed since the last run""")
+    parser.add_argument("--statefile", type=str, default=STATEFILE,
+            help="""File recording the inputs and outputs of each job for
+            --changed; defaults to '.textbuilder-state.json'""")
+    parser.add_argument("--shards", type=int, default=1,
+            help="""Number of processes rendering multi-file output, each
+            rendering a share of the items of the template's top-level
+            loop; 0 uses one per CPU. If omitted, defaults to 1""")
+    parser.add_argument("-w", "--writers", type=int, default=1,
+            help="""Number of threads writing multi-file output, so that
+            writing overlaps rendering. If omitted, defaults to 1""")
+    parser.add_argument("--outputs", type=str,
+            help="""Output manifest. Output files whose content is unchanged
+            since the last run with this manifest are not rewritten, files
+            that are written are replaced atomically, and files no longer
+            rendered are removed""")
+    parser.add_argument("--profile", type=str,
+            help="""Write the wall time, call count and memory use of each
+            phase, template, varfile and output file to this JSON report""")
+    parser.add_argument("--cprofile", type=str,
+            help="""Write a cProfile capture of the run to this file, in
+            pstats format""")
     args = parser.parse_args()
     
+    setup_logging()
+    
+    if not args.jobfile and not (args.template and args.varfile):
+        parser.error("template and varfile are required without --jobfile")
+    
     outfile = 'results.txt'
     fileid = None
     template = args.template
@@ -179,14 +1104,35 @@ if __name__ == "__main__":
     if args.fileid:
         fileid = args.fileid
     
-    logging.debug("""Running textbuilder with options:
-            template: %s
-            varfile: %s
-            outfile: %s
-            fileid: %s""",
-            template, varfile, str(outfile), str(fileid))
+    with profiling.profile(args.profile, args.cprofile,
+            enabled=bool(args.profile or args.cprofile)):
+        if args.jobfile:
+            batchbuilder(load_jobs(args.jobfile), args.processes,
+                args.cachedir, args.changed, args.statefile, args.outputs,
+                args.writers)
+        elif args.batch:
+            batchbuilder(glob_jobs(template, varfile, fileid),
+                args.processes, args.cachedir, args.changed, args.statefile,
+                args.outputs, args.writers)
+        elif args.changed:
+            job = {'template': template, 'varfile': varfile}
+            if fileid:
+                job['fileid'] = fileid
+            else:
+                job['outfile'] = outfile
+            batchbuilder([job], cachedir=args.cachedir, changed=True,
+                statefile=args.statefile, outputs=args.outputs,
+                writers=args.writers)
+        else:
+            logging.debug("""Running textbuilder with options:
+                    template: %s
+                    varfile: %s
+                    outfile: %s
+                    fileid: %s""",
+                    template, varfile, str(outfile), str(fileid))
 
-    textbuilder(template, varfile, outfile, fileid)
+            textbuilder(template, varfile, outfile, fileid, args.cachedir,
+                args.stream, args.outputs, args.writers, args.shards)
 
 
 ########## TEST CASES ############
@@ -0,0 +1,224 @@
+''' Rebuilds YAML and text files as workbooks and templates change '''
+
+import os
+import time
+import logging
+import argparse
+
+import xlyaml
+import textbuilder
+
+class Watcher():
+    '''
+    Keeps workbooks, varfiles and templates loaded between builds
+
+    Every poll() compares file modification times with the previous
+    poll. Only sheets whose contents changed are converted again, and
+    only jobs whose varfile, template or templates included, imported or
+    extended by it changed are rendered again. A job is a mapping as
+    described in textbuilder.load_jobs.
+    '''
+
+    def __init__(self, workbooks=None, jobs=None, sourceformat='list',
+            cachedir=None):
+        '''
+        Initialize the watcher; nothing is built until poll() is called
+        '''
+
+        self._workbooks = [os.path.abspath(wb) for wb in workbooks or []]
+        self._jobs = list(jobs or [])
+        self._sourceformat = sourceformat
+        self._cachedir = cachedir
+        # Last seen (mtime, size) of every watched file
+        self._stats = {}
+        # Sheet fingerprints of every workbook, keyed by sheet name
+        self._sheets = {}
+        # Loaded varfiles, keyed by absolute path
+        self._varfiles = {}
+        # Files each template is made of, keyed by absolute path
+        self._templates = {}
+
+    def stat(self, path):
+        '''
+        Return the (mtime, size) of path, or None if it does not exist
+        '''
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size)
+
+    def changed(self, path):
+        '''
+        Return True if path changed since it was last checked
+        '''
+
+        current = self.stat(path)
+        if current == self._stats.get(path) and path in self._stats:
+            return False
+        self._stats[path] = current
+        return current is not None
+
+    def templateFiles(self, template):
+        '''
+        Return the absolute paths of a template and of the templates it
+        includes, imports or extends; see textbuilder.template_dependencies
+        '''
+
+        if template not in self._templates:
+            deps = None
+            if os.path.exists(template):
+                deps = textbuilder.template_dependencies(template,
+                    self._cachedir)
+            # Templates referenced by expressions can't be known; only
+            # the template itself is watched then
+            self._templates[template] = deps[1] if deps else set([template])
+        return self._templates[template]
+
+    def convertWorkbook(self, source):
+        '''
+        Convert the changed sheets of a workbook; returns the absolute
+        paths of the YAML files written
+        '''
+
+        written = []
+        wb = xlyaml.openWorkbook(source)
+        fingerprints = self._sheets.setdefault(source, {})
+        for sheet in wb:
+            sheetName = str(sheet.title)
+            fingerprint = xlyaml.sheetFingerprint(sheet, self._sourceformat)
+            if fingerprints.get(sheetName) == fingerprint:
+                continue
+            sheetObject = xlyaml.Sheet(sheet, sourceformat=self._sourceformat)
+            collections = [xlyaml.Collection(collection) \
+                for collection in sheetObject.getCollections()]
+            outName = os.path.abspath(xlyaml.writeSheet(sheetName,
+                collections))
+            # Keep the parsed sheet so renders don't re-read the file
+            data = []
+            for this_obj in collections:
+                data.extend(this_obj.collection)
+            self._varfiles[outName] = (sheetName, data)
+            self._stats[outName] = self.stat(outName)
+            fingerprints[sheetName] = fingerprint
+            written.append(outName)
+
+        return written
+
+    def poll(self):
+        '''
+        Rebuild everything affected by changes since the last poll
+
+        Returns a dict with the YAML files written ('sheets') and the
+        files rendered ('renders')
+        '''
+
+        result = {'sheets': [], 'renders': []}
+
+        changed = set()
+        for source in self._workbooks:
+            if self.changed(source):
+                logging.info('Workbook %s changed', source)
+                written = self.convertWorkbook(source)
+                changed.update(written)
+                result['sheets'].extend(written)
+
+        checked = set()
+        for job in self._jobs:
+            varfile = os.path.abspath(job['varfile'])
+            template = os.path.abspath(job['template'])
+            if self.changed(varfile):
+                logging.info('Variable file %s changed', varfile)
+                self._varfiles[varfile] = textbuilder.load_varfile(varfile,
+                    self._cachedir)
+                changed.add(varfile)
+            for path in self.templateFiles(template) - checked:
+                checked.add(path)
+                if self.changed(path):
+                    logging.info('Template %s changed', path)
+                    changed.add(path)
+
+        # A changed template may include other templates than before
+        for template in list(self._templates):
+            if self._templates[template] & changed:
+                del self._templates[template]
+                for path in self.templateFiles(template) - checked:
+                    checked.add(path)
+                    self.changed(path)
+
+        for job in self._jobs:
+            varfile = os.path.abspath(job['varfile'])
+            template = os.path.abspath(job['template'])
+            if varfile not in changed and \
+                    not self.templateFiles(template) & changed:
+                continue
+            if varfile not in self._varfiles:
+                logging.warning('Variable file %s not found', varfile)
+                continue
+            fileid = job.get('fileid')
+            the_template = textbuilder.load_template(template, fileid,
+                self._cachedir)
+            varref, vars = self._varfiles[varfile]
+            result['renders'].extend(textbuilder.build_output(the_template,
+                {varref: vars}, job.get('outfile'), fileid, stream=True))
+
+        return result
+
+    def run(self, interval=1.0):
+        '''
+        Poll every interval seconds until interrupted
+        '''
+
+        logging.info('Watching %d workbooks and %d jobs',
+            len(self._workbooks), len(self._jobs))
+        try:
+            while True:
+                # A broken edit is reported and retried on the next change
+                # instead of stopping the watcher
+                try:
+                    result = self.poll()
+                except Exception:
+                    logging.exception('Build failed')
+                else:
+                    if result['sheets'] or result['renders']:
+                        logging.info('Wrote %d sheets and %d files',
+                            len(result['sheets']), len(result['renders']))
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            logging.info('Stopped watching')
+
+if __name__ == "__main__":
+    """
+    This runs if the program is called from the command line.
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-w", "--workbook", type=str, action="append",
+            default=[],
+            help="""Excel file converted to YAML whenever it changes; may
+            be given more than once""")
+    parser.add_argument("-j", "--jobfile", type=str,
+            help="""YAML file listing the template, varfile and outfile or
+            fileid of each job rendered when its inputs change""")
+    parser.add_argument("-f", "--sourceformat",
+            choices=['table', 'list'], default='list',
+            help="Format of Excel spreadsheets")
+    parser.add_argument("-c", "--cachedir", type=str,
+            help="""Directory holding compiled templates. If omitted,
+            defaults to the system temporary directory""")
+    parser.add_argument("-n", "--interval", type=float, default=1.0,
+            help="Seconds between checks for changes; defaults to 1")
+    args = parser.parse_args()
+
+    if not args.workbook and not args.jobfile:
+        parser.error("nothing to watch; give --workbook or --jobfile")
+
+    textbuilder.setup_logging(logging.INFO)
+    xlyaml.logger.setLevel(logging.INFO)
+
+    jobs = []
+    if args.jobfile:
+        jobs = textbuilder.load_jobs(args.jobfile)
+    watcher = Watcher(args.workbook, jobs, args.sourceformat, args.cachedir)
+    watcher.run(args.interval)
@@ -0,0 +1,24 @@
+''' Worker process pools shared by xlyaml and textbuilder '''
+
+import contextlib
+
+@contextlib.contextmanager
+def worker_pool(processes, initializer=None, initargs=()):
+    '''
+    Context manager yielding a multiprocessing.Pool of processes workers
+
+    Workers are forked when the pool is created, so they share what the
+    parent has loaded by then, e.g. a workbook or compiled templates,
+    instead of loading their own. The pool is closed when the with block
+    completes, terminated if it raises, and joined either way.
+    '''
+    import multiprocessing
+    pool = multiprocessing.Pool(processes, initializer, initargs)
+    try:
+        yield pool
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
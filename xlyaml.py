@@ -4,26 +4,283 @@ Module imports an Excel workbook and outputs a YAML file
 
 import sys
 import logging
+import os
+import csv
+import json
+import hashlib
+import marshal
 import argparse
+import itertools
+from collections import namedtuple
 
-from openpyxl import load_workbook
-from yaml import load, dump
+from outputs import OutputManifest
+import profiling
+from workers import worker_pool
+
+# Heavy modules are imported where they are used, to keep startup fast
 
 LOGLEVEL = logging.DEBUG
 
-# Create logger for module
+# Default manifest used by incremental runs
+MANIFEST = '.xlyaml-manifest.json'
+
+# Default workbook index, caching the sheet names, dimensions and
+# content fingerprints of workbooks
+INDEX = '.xlyaml-index.json'
+
+# File extension of each output format
+OUTPUT_EXTENSIONS = {'yaml': '.yml', 'json': '.json', 'marshal': '.marshal'}
+
+# Collections dumped by each serializer call when writing YAML; output
+# starts after the first batch and memory doesn't grow with the sheet
+DUMP_BATCH = 100
+
+# Delimiters of the text formats accepted in place of a workbook
+CSV_DELIMITERS = {'.csv': ',', '.tsv': '\t'}
+
+# Create logger for module; output is only set up by setupLogging()
 logger = logging.getLogger(__name__)
-logger.setLevel(LOGLEVEL)
+logger.addHandler(logging.NullHandler())
 
 # Create logging formatter
 formatter = \
     logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+# Formatter used while worker processes share the console handler
+workerFormatter = logging.Formatter( \
+    '%(asctime)s - %(name)s - %(processName)s - %(levelname)s - %(message)s')
+
+# Console handler, created by setupLogging()
+ch = None
+
+def setupLogging(level=LOGLEVEL):
+    '''
+    Send module log messages at level and above to the console
+    '''
+
+    global ch
+    if ch is None:
+        # Create a console handler and add it to logger
+        ch = logging.StreamHandler()
+        ch.setFormatter(formatter)
+        logger.addHandler(ch)
+        # Output files and profile reports are reported too
+        for name in ('outputs', 'profiling'):
+            logging.getLogger(name).addHandler(ch)
+    logger.setLevel(level)
+    for name in ('outputs', 'profiling'):
+        logging.getLogger(name).setLevel(level)
+    ch.setLevel(level)
+
+# A trimmed worksheet row: the cell values from the first to the last
+# non-empty cell, and the number of empty cells trimmed from its left
+Row = namedtuple('Row', ['indent', 'values'])
+# Builds a Row without the keyword handling of Row.__new__
+_newRow = tuple.__new__
+
+class CsvSheet():
+    '''
+    A CSV or TSV file read in place of an Excel worksheet
+
+    The sheet title is the file name without its extension, and empty
+    fields are read as empty (None) cells, as openpyxl reads them.
+    '''
+
+    def __init__(self, path):
+        self._path = path
+        self.title = os.path.splitext(os.path.basename(path))[0]
+        self._delimiter = \
+            CSV_DELIMITERS[os.path.splitext(path)[1].lower()]
+
+    def __repr__(self):
+        return '<CsvSheet "%s">' % self.title
+
+    def iterValues(self, cellRange=None):
+        '''
+        Generate the cell values of the file, or of cellRange within it
+        (e.g. 'A1:D20'), one row at a time
+        '''
+
+        if cellRange:
+            from openpyxl.utils import range_boundaries
+            minCol, minRow, maxCol, maxRow = \
+                range_boundaries(cellRange.upper())
+            width = maxCol - minCol + 1
+        with open(self._path, 'rb') as f:
+            for idx, row in enumerate(csv.reader(f,
+                    delimiter=self._delimiter), 1):
+                values = [value if value != '' else None for value in row]
+                if cellRange:
+                    if idx < minRow:
+                        continue
+                    if idx > maxRow:
+                        break
+                    # Pad short rows, as openpyxl does within a range
+                    values = values[minCol - 1:maxCol]
+                    values.extend([None] * (width - len(values)))
+                yield values
+
+class CsvWorkbook():
+    '''
+    A CSV or TSV file, or a directory of them, read in place of an
+    Excel workbook; each file is one sheet
+    '''
+
+    def __init__(self, source):
+        if os.path.isdir(source):
+            paths = [os.path.join(source, name) \
+                for name in sorted(os.listdir(source)) \
+                if isCsv(name)]
+        elif os.path.isfile(source):
+            paths = [source]
+        else:
+            raise IOError('No such file: %s' % source)
+        self._sheets = [CsvSheet(path) for path in paths]
+
+    def __iter__(self):
+        return iter(self._sheets)
+
+    def __getitem__(self, title):
+        for sheet in self._sheets:
+            if sheet.title == title:
+                return sheet
+        raise KeyError(title)
+
+def isCsv(source):
+    '''
+    Return True if source names a CSV or TSV file
+    '''
+
+    return os.path.splitext(source)[1].lower() in CSV_DELIMITERS
+
+def iterValues(worksheet, cellRange=None):
+    '''
+    Generate the cell values of an openpyxl or CSV worksheet, or of
+    cellRange within it (e.g. 'A1:D20'), one row at a time
+
+    openpyxl rows are read through iter_rows() so that read-only
+    worksheets are never materialized as a whole, and are read no
+    further than the last row of cellRange.
+    '''
+
+    if isinstance(worksheet, CsvSheet):
+        return worksheet.iterValues(cellRange)
+    if cellRange:
+        rows = worksheet.iter_rows(cellRange)
+    else:
+        rows = worksheet.iter_rows()
+    return ([cell.value for cell in row] for row in rows)
+
+# Text read as a boolean by the 'bool' and 'auto' cell types
+TRUE_TEXT = frozenset(['true', 'yes', 'on'])
+FALSE_TEXT = frozenset(['false', 'no', 'off'])
+# First characters of the text the 'auto' cell type reads as a number
+NUMBER_START = frozenset('0123456789+-.')
+
+def _toStr(value):
+    if value is None or isinstance(value, basestring):
+        return value
+    return str(value)
+
+def _toInt(value):
+    if value is None or isinstance(value, (int, long)):
+        return value
+    if isinstance(value, basestring):
+        try:
+            return int(value)
+        except ValueError:
+            value = float(value)
+    if value != int(value):
+        raise ValueError('%r is not a whole number' % value)
+    return int(value)
 
-# Create a console handler and add it to logger
-ch = logging.StreamHandler()
-ch.setLevel(LOGLEVEL)
-ch.setFormatter(formatter)
-logger.addHandler(ch)
+def _toFloat(value):
+    if value is None:
+        return value
+    return float(value)
+
+def _toBool(value):
+    if value is None or isinstance(value, bool):
+        return value
+    if isinstance(value, basestring):
+        text = value.strip().lower()
+        if text in TRUE_TEXT:
+            return True
+        if text in FALSE_TEXT:
+            return False
+        value = float(text)
+    return bool(value)
+
+def _toDate(value):
+    import datetime
+    if value is None:
+        return value
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    if not isinstance(value, basestring):
+        raise ValueError('%r is not a date' % value)
+    return datetime.datetime.strptime(value.strip(), '%Y-%m-%d').date()
+
+def _toAuto(value):
+    # Native workbook values pass through; text, e.g. from CSV files, is
+    # read as the number or boolean it spells, if any
+    if not isinstance(value, basestring):
+        return value
+    text = value.strip().lower()
+    # Numbers with leading zeros, e.g. '0010', are kept as text
+    if text[:1] in NUMBER_START and not (text[:1] == '0' and
+            text[1:2].isdigit()):
+        try:
+            return int(text)
+        except ValueError:
+            pass
+        try:
+            number = float(text)
+        except ValueError:
+            pass
+        else:
+            # Nor are '-inf' and '+nan'
+            if number - number == 0:
+                return number
+    if text in TRUE_TEXT:
+        return True
+    if text in FALSE_TEXT:
+        return False
+    return value
+
+# Converters of the cell types accepted by typed sheets
+CELL_TYPES = {
+    'str': _toStr,
+    'int': _toInt,
+    'float': _toFloat,
+    'bool': _toBool,
+    'date': _toDate,
+    'auto': _toAuto,
+    }
+
+def compileConverter(type, name=None):
+    '''
+    Return the function converting the cells of column or key name to
+    type, one of CELL_TYPES; empty cells stay None
+
+    A cell that can't be converted raises ValueError naming the column.
+    '''
+
+    if type not in CELL_TYPES:
+        raise ValueError('Invalid type for %s: %s' % (name, type))
+    convert = CELL_TYPES[type]
+    if type in ('str', 'auto'):
+        # These never fail, so they are used as they are
+        return convert
+
+    def converter(value):
+        try:
+            return convert(value)
+        except (TypeError, ValueError):
+            raise ValueError('Cannot read %r of %s as %s' % (value, name,
+                type))
+    return converter
 
 class Sheet():
     """
@@ -72,6 +329,10 @@ class Sheet():
                 __________________________________________________
                 |    (blank)  |   Item 3  |    Item 3 |   Item 3  |
 
+    Cells are read as strings unless the sheet is typed. A typed sheet
+    keeps numbers, booleans and dates as they are, and empty cells as
+    None; each table column, or the values of each list key, named in
+    the types mapping is converted to its type, see CELL_TYPES.
     """
     
     def __init__(self, worksheet, **kwargs):
@@ -81,8 +342,19 @@ class Sheet():
         Acceptable keyword args are:
             - sourceformat=<'list' | 'table'>
                 default is 'list'
+            - streaming=<True | False>
+                default is False; when True, rows are not parsed up front
+                and getCollections() returns a generator of objects
+            - cellrange=<range>
+                default is None; only the cells of range, e.g. 'A1:D20',
+                are parsed
+            - types=<dict>
+                default is None; cells are read as strings. A dict, even
+                an empty one, makes the sheet typed: it maps table column
+                names or list keys to a type of CELL_TYPES, and other
+                cells are read as 'auto'
         '''
-        
+
         self._kw_options = {}
         for k, v in kwargs.iteritems():
             self._kw_options[k] = v
@@ -96,90 +368,290 @@ class Sheet():
         # Update source_format if it was manually set in class call
         if 'sourceformat' in self._kw_options:
             self._source_format = self._kw_options['sourceformat']
-        
+
+        self._streaming = bool(self._kw_options.get('streaming', False))
+        self._cellrange = self._kw_options.get('cellrange')
+        self._types = self._kw_options.get('types')
+
         logger.debug('source format for evaluating %s is %s', \
             str(self._ws), str(self._source_format))
 
         # Validate the source format is valid; call parse() with
         # appropriate format
-        if self._source_format == 'table':
-            self.parse(format='table')
-        elif self._source_format == 'list':
-            self.parse(format='list')
-        else:
+        if self._source_format not in ('table', 'list'):
             logger.error('Invalid sourceformat: %s', \
                 self._kw_options['sourceformat'])
             return None
-        
-    def parse(self, format='list'):
+        # Streaming sheets are parsed lazily by getCollections()
+        if not self._streaming:
+            self.parse(format=self._source_format)
+
+    def iterRows(self):
         '''
-        Parse the worksheet and identify objects
+        Generate the cell values of the worksheet, one row at a time
+        '''
+
+        return iterValues(self._ws, self._cellrange)
+
+    def iterObjects(self, format='list'):
+        '''
+        Generate the objects of the worksheet, one object at a time
+
+        Each object is a list of Row tuples, trimmed once here so that
+        Collection does not have to clean them again.
 
         Acceptable keyword args are:
             - format=<'list' | 'table'>
         '''
-        
-        logger.debug('Beginning parse() of %s' , self._ws)
-        
+
         if format == 'list':
             logger.debug('parsing as list...')
+            if self._types is not None:
+                # Converters of the declared keys, compiled once
+                converters = dict((key, compileConverter(type, key)) \
+                    for key, type in self._types.iteritems())
+                # Converters for the rows under the last header at each
+                # indent
+                columns = []
+            # Typed rows are converted once the next row shows whether
+            # they are headers
+            pending = None
             this_obj = []
-            for row in self._ws.rows:
-                this_row = []
-                empty = True
-                for cell in row:
-                    if cell.value:
-                        this_row.append(str(cell.value))
-                        empty = False
-                    else:
-                        this_row.append(cell.value)
-                if not empty:
-                    this_obj.append(this_row)
-                else:
-                    self._objects.append(this_obj)
+            for values in self.iterRows():
+                if not any(values):
+                    if pending is not None:
+                        this_obj.append(self._typedRow(pending, False,
+                            columns, converters))
+                        pending = None
+                    yield this_obj
                     this_obj = []
+                    continue
+                # Trim empty cells from both sides; the left trim is the
+                # indent of the row
+                left = 0
+                while values[left] is None:
+                    left += 1
+                right = len(values)
+                while values[right - 1] is None:
+                    right -= 1
+                if self._types is None:
+                    this_obj.append(_newRow(Row, (left, tuple([intern( \
+                        str(value)) if value else value \
+                        for value in values[left:right]]))))
+                    continue
+                if pending is not None:
+                    this_obj.append(self._typedRow(pending,
+                        left > pending[0], columns, converters))
+                pending = (left, values[left:right])
+            if pending is not None:
+                this_obj.append(self._typedRow(pending, False, columns,
+                    converters))
             if this_obj:
-                self._objects.append(this_obj)
-        
+                yield this_obj
+
         elif format == 'table':
             logger.debug('parsing as table...')
-            keys = []
+            rows = self.iterRows()
             # Determine keys for key-value pairs
-            for cell in self._ws.rows[0]:
-                keys.append(cell.value)
+            keys = [intern(str(key)) for key in next(rows, [])]
             logger.debug('keys are %s', str(keys))
+            # Typed sheets compile the converter of each column once
+            converters = None
+            if self._types is not None:
+                converters = [compileConverter(self._types.get(key, 'auto'),
+                    key) for key in keys]
             # Cycle through remaining rows and build key-value pairs
-            # into object list; append object lists to list of sheet objects
-            for row in self._ws.rows[1:]:
+            # into object list
+            for values in rows:
+                # Rows of text files may be shorter than the header;
+                # pad them with empty cells as a worksheet would
+                if len(values) < len(keys):
+                    values = values + [None] * (len(keys) - len(values))
+                # Rows longer than the header get the key 'None' for their
+                # extra cells, as openpyxl pads the header row
+                elif len(values) > len(keys):
+                    extra = len(values) - len(keys)
+                    keys.extend(['None'] * extra)
+                    if converters is not None:
+                        converters.extend([compileConverter( \
+                            self._types.get('None', 'auto'), 'None')] * extra)
                 this_obj = []
-                for idx in range(len(row)):
-                    key = str(keys[idx])
-                    val = str(row[idx].value)
-                    this_obj.append([key, val])
-                self._objects.append(this_obj)
-        
+                for idx in range(len(values)):
+                    if converters is None:
+                        val = str(values[idx])
+                    else:
+                        val = converters[idx](values[idx])
+                    this_obj.append(_newRow(Row, (0, (keys[idx], val))))
+                yield this_obj
+
         # Handle case where source format is not valid
         else:
             logger.error('Invalid sourceformat %s', format)
+
+    def _typedRow(self, row, header, columns, converters):
+        '''
+        Return the Row of the trimmed cells of a list-format row of a
+        typed sheet, given as (indent, cells); header is True if the rows
+        that follow are nested under it
+
+        Keys, and the key names of a dict header, stay text. A row under
+        a dict header takes the converters of the header's key names, and
+        the items of a list the converter of the list's key; otherwise
+        the values of a declared key are converted to its type. columns
+        holds, for each indent, the converters for the rows under the
+        last header at that indent, and is updated for this row.
+        '''
+
+        indent, cells = row
+        parent = None
+        if 0 < indent <= len(columns):
+            parent = columns[indent - 1]
+        del columns[indent:]
+
+        if header:
+            cells = tuple([_toStr(value) for value in cells])
+            if len(cells) > 1:
+                # A dict header names its keys after the first cell
+                child = [converters.get(name) for name in cells[1:]]
+            else:
+                child = converters.get(cells[0])
+            columns.extend([None] * (indent - len(columns)))
+            columns.append((len(cells) > 1, child))
+        elif parent is not None and parent[0]:
+            cells = tuple([((parent[1][idx] if idx < len(parent[1]) \
+                else None) or _toAuto)(value) \
+                for idx, value in enumerate(cells)])
+        elif len(cells) == 1:
+            # An item of a list
+            convert = _toAuto
+            if parent is not None and parent[1] is not None:
+                convert = parent[1]
+            cells = (convert(cells[0]),)
+        else:
+            convert = converters.get(cells[0], _toAuto)
+            cells = (_toStr(cells[0]),) + tuple([convert(value) \
+                for value in cells[1:]])
+
+        return _newRow(Row, (indent, cells))
+
+    def parse(self, format='list'):
+        '''
+        Parse the worksheet and identify objects
+
+        Acceptable keyword args are:
+            - format=<'list' | 'table'>
+        '''
+        
+        logger.debug('Beginning parse() of %s' , self._ws)
+        
+        if format not in ('list', 'table'):
+            logger.error('Invalid sourceformat %s', format)
             return None
 
+        with profiling.phase('parse', getattr(self._ws, 'title', None)):
+            for this_obj in self.iterObjects(format=format):
+                self._objects.append(this_obj)
+
         logger.debug('Completed parse() of %s', self._ws)
             
     def getCollections(self):
         '''
         Return the collection of objects contained within the sheet
+
+        Streaming sheets return a generator that parses the worksheet
+        one object at a time.
         '''
         
+        if self._streaming:
+            return self.iterObjects(format=self._source_format)
         return self._objects
+
+    def iterCollections(self, interner=None):
+        '''
+        Generate a Collection for each object of the sheet
+
+        For streaming sheets, rows are read, cut into objects and built
+        into collections one object at a time. Collections share their
+        repeated lists and dicts through interner, if it is given; see
+        Interner.
+        '''
+
+        title = getattr(self._ws, 'title', None)
+        objects = iter(self.getCollections())
+        while True:
+            with profiling.phase('parse', title):
+                this_obj = next(objects, None)
+            if this_obj is None:
+                return
+            with profiling.phase('parseObject', title):
+                collection = Collection(this_obj, interner)
+            yield collection
     
+class Interner():
+    '''
+    Shares one copy of each structurally identical list or dict among
+    the collections built with it
+
+    A list or dict is looked up by its values, and by the identity of
+    the interned lists and dicts it holds, so nested blocks are compared
+    without walking them again. YAML writes a shared copy once, under an
+    anchor, and an alias wherever else it appears. Shared copies must
+    not be changed once interned.
+    '''
+
+    def __init__(self):
+        # Canonical copy of each list and dict, keyed by its structure
+        self._table = {}
+        # Ids of the canonical copies
+        self._canonical = set()
+
+    def intern(self, obj):
+        '''
+        Return the canonical copy of obj, after interning the lists and
+        dicts it holds; other values, and empty lists and dicts, are
+        returned as they are
+        '''
+
+        if not obj or id(obj) in self._canonical:
+            return obj
+        if isinstance(obj, list):
+            for idx in range(len(obj)):
+                obj[idx] = self.intern(obj[idx])
+            key = (list, tuple([self._ref(value) for value in obj]))
+        elif isinstance(obj, dict):
+            for k in obj:
+                obj[k] = self.intern(obj[k])
+            key = (dict, frozenset([(k, self._ref(value)) \
+                for k, value in obj.iteritems()]))
+        else:
+            return obj
+
+        canonical = self._table.setdefault(key, obj)
+        self._canonical.add(id(canonical))
+        return canonical
+
+    def _ref(self, value):
+        # Interned lists and dicts are told apart by identity; the type
+        # keeps e.g. 1, 1.0 and True apart
+        if isinstance(value, (list, dict)):
+            return id(value) if value else (type(value),)
+        return (type(value), value)
+
 class Collection():
     '''
     Individual objects to be converted into other formats
     '''
     
-    def __init__(self, array):
-        
+    def __init__(self, array, interner=None):
+        '''
+        Build the object of array; its lists and dicts are shared with
+        other collections through interner, if it is given
+        '''
+
         self._this_collection = self.parseObject(array)
+        if interner is not None:
+            self._this_collection = [interner.intern(obj) \
+                for obj in self._this_collection]
         
     def clean(self, array, side='left'):
         result = list(array)
@@ -262,12 +734,58 @@ class Collection():
                     temp_list.append(temp_dict)
                 return { var : temp_list }
                 
-    def parseObject(self, array):
+    def parseObject(self, array, linear=True):
         '''
         Take raw input array, clean it, use buildObject to 
         compile a top-level Python object out of array
+
+        Rows that Sheet has already trimmed into Row tuples are used
+        as they are; raw rows are cleaned first.
+
+        Acceptable keyword args are:
+            - linear=<True | False>
+                default is True; when False, the original collapse
+                loop (collapseTree) is used instead of buildTree
         '''
         
+        if array and isinstance(array[0], Row):
+            initObject = [row.values for row in array]
+            indentList = [row.indent for row in array]
+        else:
+            initObject, indentList = self.cleanRows(array)
+        
+        if linear:
+            workingResult = self.buildTree(initObject, indentList)
+        else:
+            workingResult = self.collapseTree(initObject, indentList)
+        
+        for idx in range(len(workingResult)):
+            this_obj = [workingResult[idx]]
+            ### print "this obj = " , this_obj
+            temp_item = self.buildObject(this_obj, final=True)
+            workingResult[idx] = temp_item
+        
+        ### print "working result: \n ", workingResult
+        
+        ### print "\n\n\n\n"
+        ### print "Items:"
+        final_dict = {}
+        for item in workingResult:
+            ### print item
+            if type(item) == dict:
+                for key in item.keys():
+                    final_dict[key] = item[key]
+        ### print "final dict: ", final_dict
+
+        return [final_dict]
+
+    def cleanRows(self, array):
+        '''
+        Trim the empty (None) cells from both sides of raw rows
+
+        Returns the trimmed rows and the list of line indentions
+        '''
+
         # Clean right side of array; remove extra empty (None) cells
         initObject = [None for row in range(len(array))]
         for idx in range(len(array)):
@@ -284,8 +802,56 @@ class Collection():
                 initObject[idx] = temp_item
         ### print "final clean list is ", initObject
         ### print "indent list is", indentList
-        
-        workingResult = list(initObject)
+
+        return initObject, indentList
+
+    def buildTree(self, rows, indentList):
+        '''
+        Compile cleaned rows down to indent level 0 in a single pass
+
+        Each row is held on a stack until a row at the same or a lower
+        indent closes it; a closed row that has children is replaced by
+        the object buildObject builds from it and its children. Returns
+        the same level 0 rows as collapseTree.
+        '''
+
+        result = []
+        # Stack entries are [indent, row, child rows]
+        stack = []
+        for idx in range(len(rows)):
+            indent = indentList[idx]
+            while stack and stack[-1][0] >= indent:
+                self._closeRow(stack, result)
+            stack.append([indent, rows[idx], []])
+        while stack:
+            self._closeRow(stack, result)
+
+        return result
+
+    def _closeRow(self, stack, result):
+        '''
+        Pop the top row off the buildTree stack and hand it to its parent
+        '''
+
+        indent, row, children = stack.pop()
+        if children:
+            row = [self.buildObject([row] + children)]
+        if stack:
+            stack[-1][2].append(row)
+        else:
+            result.append(row)
+
+    def collapseTree(self, rows, indentList):
+        '''
+        Compile cleaned rows down to indent level 0 by repeatedly
+        collapsing the deepest block
+
+        This is the original quadratic algorithm; it is kept as the
+        reference implementation for buildTree.
+        '''
+
+        indentList = list(indentList)
+        workingResult = list(rows)
         ### print "working result is ", workingResult
         
         parentList = self.buildParentList(indentList)
@@ -337,27 +903,7 @@ class Collection():
             logger.debug('reseting maxIndent')
             maxIndent = max(indentList)
         
-        ### print "level 0 working result: \n", workingResult
-        
-        for idx in range(len(workingResult)):
-            this_obj = [workingResult[idx]]
-            ### print "this obj = " , this_obj
-            temp_item = self.buildObject(this_obj, final=True)
-            workingResult[idx] = temp_item
-        
-        ### print "working result: \n ", workingResult
-        
-        ### print "\n\n\n\n"
-        ### print "Items:"
-        final_dict = {}
-        for item in workingResult:
-            ### print item
-            if type(item) == dict:
-                for key in item.keys():
-                    final_dict[key] = item[key]
-        ### print "final dict: ", final_dict
-
-        return [final_dict]
+        return workingResult
 
     def buildOutput(self, type='yaml'):
         '''
@@ -365,22 +911,422 @@ class Collection():
         writing to output files
         '''
         
-        if type == 'yaml':
-            result = dump(self._this_collection, default_flow_style=False)
-        
-        return result
+        return dumpCollections([self], type=type)
 
     @property
     def collection(self):
         return self._this_collection
+
+def yamlDumper():
+    '''
+    Return the libyaml-backed safe dumper if PyYAML was built with it,
+    or the pure-Python one
+    '''
+
+    import yaml
+    return getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+def _jsonDate(value):
+    # Dates of typed sheets are written to JSON as ISO 8601 text
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    raise TypeError('%r is not JSON serializable' % value)
+
+def dumpCollections(collections, type='yaml'):
+    '''
+    Generates the text version of a list of Collection objects with a
+    single serializer call
+
+    Acceptable types are:
+        - 'yaml': block-style YAML; the result is the same text as
+            joining the buildOutput() of each collection
+        - 'json': compact JSON
+        - 'marshal': Python marshal data; fastest to load, but only
+            readable by the same Python version, and unable to hold the
+            dates of typed sheets
+    '''
+
+    data = []
+    for collection in collections:
+        data.extend(collection.collection)
+
+    if type == 'yaml':
+        import yaml
+        result = yaml.dump(data, Dumper=yamlDumper(),
+            default_flow_style=False)
+    elif type == 'json':
+        result = json.dumps(data, sort_keys=True, separators=(',', ':'),
+            default=_jsonDate)
+    elif type == 'marshal':
+        result = marshal.dumps(data, 2)
+    else:
+        raise ValueError('Invalid output format: %s' % type)
+
+    return result
+
+def outputName(sheetName, format='yaml'):
+    '''
+    Return the name of the file a sheet is written to in format
+    '''
+
+    return sheetName + OUTPUT_EXTENSIONS[format]
+
+def sheetChunks(sheetName, collections, format='yaml', streaming=False,
+        anchors=False):
+    '''
+    Generate the text of the file a sheet of Collection objects is
+    written to
+
+    YAML is dumped DUMP_BATCH collections at a time as the iterable
+    yields them, or one at a time when streaming, so that a generator
+    of collections is never held whole. With anchors, the sheet is
+    dumped in one call instead, so that the aliases of shared lists and
+    dicts can refer to anchors anywhere in the sheet; see Interner.
+    '''
+
+    if format != 'yaml':
+        # Other formats hold one document, so the sheet is dumped whole
+        collections = list(collections)
+        with profiling.phase('dump', sheetName):
+            text = dumpCollections(collections, type=format)
+        yield text
+        return
+
+    yield '# ' + sheetName + '\n---\n'
+    size = 1 if streaming else DUMP_BATCH
+    if anchors:
+        size = None
+    collections = iter(collections)
+    while True:
+        batch = list(itertools.islice(collections, size))
+        if not batch:
+            break
+        with profiling.phase('dump', sheetName):
+            text = dumpCollections(batch, type=format)
+        yield text
+    yield '...'
+
+def writeSheet(sheetName, collections, format='yaml', streaming=False,
+        manifest=None, group=None, anchors=False):
+    '''
+    Write Collection objects to '<sheetName>.yml', or the extension
+    of a non-YAML format; see sheetChunks
+
+    If manifest is given, the file is written through it under group;
+    see outputs.OutputManifest. Returns the name of the output file
+    '''
+
+    outName = outputName(sheetName, format)
+    chunks = sheetChunks(sheetName, collections, format, streaming, anchors)
+
+    if manifest is not None:
+        manifest.write(group, outName, chunks)
+        return outName
+
+    # The sheet is written to a temporary file renamed over outName once
+    # it is complete, so a failed dump doesn't leave a truncated file
+    tmpName = '%s.%d.tmp' % (outName, os.getpid())
+    try:
+        with open(tmpName, 'w' if format == 'yaml' else 'wb') as outFile:
+            logger.debug('Opened output file %s', outFile)
+            for chunk in chunks:
+                with profiling.phase('write', outName):
+                    outFile.write(chunk)
+        os.rename(tmpName, outName)
+    except:
+        if os.path.exists(tmpName):
+            os.remove(tmpName)
+        raise
+    logger.info('Completed output file %s', outName)
+
+    return outName
+
+def convertSheet(sheet, sourceformat='list', format='yaml', streaming=False,
+        manifest=None, group=None, cellRange=None, types=None,
+        anchors=False):
+    '''
+    Convert a single worksheet, or cellRange within it, and write it to
+    '<sheet>.yml', or the extension of a non-YAML format, through
+    manifest if it is given; types makes the sheet typed, see Sheet
+
+    With anchors, repeated lists and dicts of the sheet are built once
+    and written once, with YAML aliases referring back to them
+
+    Returns the name of the output file
+    '''
+
+    logger.info('Beginning evaluation of sheet %s', sheet)
+    with profiling.phase('sheet', sheet.title):
+        # Rows are parsed as they are written, whether or not the
+        # workbook was opened read-only
+        sheetObject = Sheet(sheet, sourceformat=sourceformat,
+            streaming=True, cellrange=cellRange, types=types)
     
-    
-    
+        # Cycle through collection objects contained in sheet
+        logger.debug('Building collection objects found in %s', sheet)
+        collections = sheetObject.iterCollections(
+            Interner() if anchors else None)
+
+        return writeSheet(str(sheet.title), collections, format=format,
+            streaming=streaming, manifest=manifest, group=group,
+            anchors=anchors)
+
+def openWorkbook(source, read_only=False):
+    '''
+    Open the workbook at source, exiting with a message if it can't be read
+
+    A CSV or TSV file, or a directory of them, is opened as a CsvWorkbook.
+    '''
+
+    try:
+        with profiling.phase('load_workbook', source):
+            if os.path.isdir(source) or isCsv(source):
+                return CsvWorkbook(source)
+            from openpyxl import load_workbook
+            return load_workbook(source, read_only=read_only)
+    except:
+        print "Unable to open workbook:", source
+        print "Please check filename and try again."
+        print "\n\n"
+        sys.exit(2)
+
+def workbookData(source, sourceformat='list', streaming=False, output=False,
+        types=None, anchors=False):
+    '''
+    Return the objects of every worksheet, keyed by sheet name
+
+    Each value is the list of objects that loading the sheet's YAML file
+    would produce, so it can be handed to a template without writing and
+    re-reading the file. With output=True, '<sheet>.yml' is written too.
+    types makes the sheets typed; see Sheet. With anchors, the repeated
+    lists and dicts of each sheet are shared; see Interner.
+    '''
+
+    logger.info('Opening workbook %s', source)
+    logger.info('Reading workbook in %s format', sourceformat)
+    wb = openWorkbook(source, read_only=streaming)
+
+    data = {}
+    for sheet in wb:
+        logger.info('Beginning evaluation of sheet %s', sheet)
+        sheetName = str(sheet.title)
+        sheetObject = Sheet(sheet, sourceformat=sourceformat,
+            streaming=streaming, types=types)
+        interner = Interner() if anchors else None
+        collections = [Collection(collection, interner) \
+            for collection in sheetObject.getCollections()]
+        if output:
+            writeSheet(sheetName, collections, anchors=anchors)
+        data[sheetName] = []
+        for this_obj in collections:
+            data[sheetName].extend(this_obj.collection)
+
+    return data
+
+def indexSheet(sheet, cellRange=None):
+    '''
+    Return the index entry of a worksheet, or of cellRange within it: a
+    dict of its 'dimensions', e.g. 'A1:D20', and a 'fingerprint', the
+    hex digest of its cell values
+    '''
+
+    digest = hashlib.sha1()
+    rows = columns = 0
+    for values in iterValues(sheet, cellRange):
+        digest.update(repr(tuple(values)))
+        digest.update('\n')
+        rows += 1
+        columns = max(columns, len(values))
+
+    dimensions = None
+    if rows and columns:
+        from openpyxl.utils import get_column_letter
+        dimensions = 'A1:%s%d' % (get_column_letter(columns), rows)
+    return {'dimensions': dimensions, 'fingerprint': digest.hexdigest()}
+
+def sheetFingerprint(sheet, sourceformat='list', format='yaml',
+        cellRange=None, content=None, types=None, anchors=False):
+    '''
+    Return a hex digest of the cell values of a worksheet, or of
+    cellRange within it, and the options it is converted with
+
+    content is the fingerprint of the cell values if it is known
+    already, e.g. from the workbook index; see indexSheet
+    '''
+
+    if content is None:
+        content = indexSheet(sheet, cellRange)['fingerprint']
+    digest = hashlib.sha1()
+    if types is not None:
+        types = sorted(types.items())
+    digest.update(repr((sourceformat, format, cellRange, types, anchors)))
+    digest.update(content)
+
+    return digest.hexdigest()
+
+def sourceKey(source):
+    '''
+    Return the name, size and mtime of the file, or CSV/TSV files, read
+    for a workbook; the index of a workbook is valid while they match
+    '''
+
+    if os.path.isdir(source):
+        paths = [os.path.join(source, name) \
+            for name in sorted(os.listdir(source)) if isCsv(name)]
+    else:
+        paths = [source]
+    key = []
+    for path in paths:
+        st = os.stat(path)
+        key.append([os.path.basename(path), st.st_size, st.st_mtime])
+
+    return key
+
+def workbookIndex(source, path=INDEX, titles=None, wb=None):
+    '''
+    Return the index of a workbook, cached in the index file at path
+
+    The index is a dict holding the sheet 'titles', in workbook order,
+    and the entry of each sheet under 'sheets'; see indexSheet. Entries
+    are only built for titles, or for every sheet if titles is None,
+    and only if the cache doesn't hold them. A cached index is dropped
+    once the workbook changes; see sourceKey. wb is the workbook, if it
+    is open already.
+    '''
+
+    try:
+        with open(path, 'r') as f:
+            workbooks = json.load(f).get('workbooks', {})
+    except (IOError, ValueError):
+        logger.debug('No usable workbook index found at %s', path)
+        workbooks = {}
+
+    name = os.path.abspath(source)
+    key = sourceKey(source)
+    index = workbooks.get(name)
+    if index is None or index['key'] != key:
+        if wb is None:
+            wb = openWorkbook(source, read_only=True)
+        index = {'key': key, 'titles': [sheet.title for sheet in wb],
+            'sheets': {}}
+    if titles is None:
+        titles = index['titles']
+
+    missing = [title for title in titles if title not in index['sheets']]
+    if missing:
+        if wb is None:
+            wb = openWorkbook(source, read_only=True)
+        for title in missing:
+            logger.debug('Indexing sheet %s', title)
+            index['sheets'][title] = indexSheet(wb[title])
+        workbooks[name] = index
+        with open(path, 'w') as f:
+            json.dump({'workbooks': workbooks}, f, indent=2, sort_keys=True)
+        logger.debug('Wrote workbook index %s', path)
+
+    return index
+
+def loadManifest(path):
+    '''
+    Return the sheet fingerprints recorded by the last incremental run
+    '''
+
+    try:
+        with open(path, 'r') as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        logger.debug('No usable manifest found at %s', path)
+        return {}
+
+    return manifest.get('sheets', {})
+
+def saveManifest(path, fingerprints):
+    '''
+    Record the sheet fingerprints of an incremental run
+    '''
+
+    with open(path, 'w') as f:
+        json.dump({'sheets': fingerprints}, f, indent=2, sort_keys=True)
+    logger.debug('Wrote manifest %s', path)
+
+# Workbook opened once by each worker process of a parallel xlyaml() run
+_worker_wb = None
+# Output manifest of each worker process, if the run has one
+_worker_manifest = None
+
+def _initWorker(source, streaming, manifest=None):
+    '''
+    Open the workbook in a worker process of a parallel xlyaml() run
+    '''
+
+    global _worker_wb, _worker_manifest
+    _worker_wb = openWorkbook(source, read_only=streaming)
+    _worker_manifest = manifest
+
+def _convertWorkerSheet(args):
+    '''
+    Convert one named worksheet inside a worker process; returns the
+    output file name and what the output manifest recorded for it
+    '''
+
+    title, sourceformat, format, streaming, group, cellRange, types, \
+        anchors = args
+    outName = convertSheet(_worker_wb[title], sourceformat=sourceformat,
+        format=format, streaming=streaming, manifest=_worker_manifest,
+        group=group, cellRange=cellRange, types=types, anchors=anchors)
+    if _worker_manifest is None:
+        return outName, None
+    return outName, _worker_manifest.export(group)
+
 def xlyaml(source, output=None, format='yaml', **kwargs):
     '''
     Primary function for building YAML document from workbook
+
+    format may be 'yaml', 'json' or 'marshal'; see dumpCollections.
+
+    source may also be a CSV or TSV file, or a directory of them, each
+    file being read as one sheet named after the file.
+
+    Acceptable keyword args are:
+        - sourceformat=<'list' | 'table'>
+            default is 'list'
+        - streaming=<True | False>
+            default is False; when True, the workbook is opened read-only
+            and each sheet is parsed and written one object at a time
+        - jobs=<int>
+            default is 1; number of worker processes used to convert
+            sheets in parallel, 0 uses one process per CPU
+        - incremental=<True | False>
+            default is False; when True, sheets whose fingerprint matches
+            the manifest are skipped and their output file is left as is
+        - manifest=<filename>
+            default is MANIFEST; manifest used by incremental runs
+        - outputs=<filename>
+            default is None; output manifest holding the content hash of
+            each file written, see outputs.OutputManifest. Files whose
+            content is unchanged are not rewritten, and files of sheets
+            no longer in the workbook are removed
+        - sheets=<list of sheet names>
+            default is None; only these sheets are converted, and no
+            other sheet of the workbook is read
+        - cellrange=<range>
+            default is None; only the cells of range, e.g. 'A1:D20', of
+            each sheet are converted
+        - index=<filename>
+            default is INDEX; workbook index used by incremental runs,
+            see workbookIndex
+        - types=<dict>
+            default is None; cells are read as strings. A dict, even an
+            empty one, keeps numbers, booleans and dates as they are and
+            converts the columns or list keys it names, see Sheet
+        - anchors=<True | False>
+            default is False; when True, structurally identical lists and
+            dicts of a sheet are built once, and YAML output writes them
+            once under an anchor and refers back to them with aliases
     '''
     
+    import multiprocessing
+
     options = {}
     for k, v in kwargs.iteritems():
         options[k] = v
@@ -388,18 +1334,32 @@ def xlyaml(source, output=None, format='yaml', **kwargs):
         sourceformat = options['sourceformat']
     else:
         sourceformat = 'list'
+    streaming = bool(options.get('streaming', False))
+    jobs = options.get('jobs', 1)
+    if not jobs:
+        jobs = multiprocessing.cpu_count()
+    incremental = bool(options.get('incremental', False))
+    manifest = options.get('manifest', MANIFEST)
+    outputs = None
+    if options.get('outputs'):
+        outputs = OutputManifest(options['outputs'])
+    group = os.path.abspath(source)
+    selected = options.get('sheets')
+    cellRange = options.get('cellrange')
+    index = options.get('index', INDEX)
+    types = options.get('types')
+    anchors = bool(options.get('anchors', False))
 
     logger.info('Opening workbook %s', source)
     logger.info('Reading workbook in %s format', sourceformat)
+    if streaming:
+        logger.info('Streaming workbook in read-only mode')
 
-    # Open workbook
-    try:
-        wb = load_workbook(source)
-    except:
-        print "Unable to open workbook:", source
-        print "Please check filename and try again."
-        print "\n\n"
-        sys.exit(2)
+    # Open workbook; a parallel run only needs the sheet names here, and
+    # read-only sheets are only read when they are converted, so the
+    # workbook is opened read-only unless every sheet is read anyway
+    wb = openWorkbook(source, read_only=(streaming or jobs > 1 or
+        bool(selected) or incremental))
     
     # Gather names of worksheets within the workbook
     worksheets = []
@@ -407,32 +1367,80 @@ def xlyaml(source, output=None, format='yaml', **kwargs):
         worksheets.append(sheet)
         logger.debug('Found sheet: %s', sheet)
     logger.info('Found %d sheets', len(worksheets))    
+
+    if selected:
+        titles = [sheet.title for sheet in worksheets]
+        missing = [title for title in selected if title not in titles]
+        if missing:
+            raise ValueError('No such sheet in %s: %s' % (source,
+                ', '.join(missing)))
+        worksheets = [sheet for sheet in worksheets \
+            if sheet.title in selected]
+        logger.info('Converting %d selected sheets', len(worksheets))
+        # Sheets that aren't selected keep their output files
+        if outputs is not None:
+            outputs.keep(group)
+
+    # Drop sheets whose contents and options have not changed since the
+    # last incremental run
+    if incremental:
+        previous = loadManifest(manifest)
+        fingerprints = {}
+        if selected:
+            fingerprints.update(previous)
+        contents = {}
+        if not cellRange:
+            contents = workbookIndex(source, index,
+                [sheet.title for sheet in worksheets], wb)['sheets']
+        changed = []
+        for sheet in worksheets:
+            title = sheet.title
+            content = None
+            if title in contents:
+                content = contents[title]['fingerprint']
+            fingerprints[title] = sheetFingerprint(sheet, sourceformat,
+                format, cellRange, content, types, anchors)
+            if previous.get(title) == fingerprints[title] and \
+                    os.path.exists(outputName(str(title), format)):
+                logger.info('Sheet %s is unchanged; skipping', sheet)
+                if outputs is not None:
+                    outputs.keep(group, [outputName(str(title), format)])
+            else:
+                changed.append(sheet)
+        worksheets = changed
+        logger.info('%d sheets changed since last run', len(worksheets))
     
-    for sheet in worksheets:
-        logger.info('Beginning evaluation of sheet %s', sheet)
-        sheetObject = Sheet(sheet, sourceformat=sourceformat)
-        collectionObjects = sheetObject.getCollections()
-        
-        # Set up output file that will correlate to the current sheet
-        sheetName = str(sheet.title)
-        outFile = open(sheetName + '.yml', 'w')
-        logger.debug('Opened output file %s', outFile)
-        outFile.write('# ' + sheetName)
-        outFile.write('\n')
-        outFile.write('---')
-        outFile.write('\n')
-        
-        # Cycle through collection objects contained in sheet
-        logger.debug('Building collection objects found in %s', sheet)
-        for collection in collectionObjects:
-            this_obj = Collection(collection)
-            outFile.write(this_obj.buildOutput(type=format))
-            outFile.write('\n')
-        
-        # Clean up current output file before moving to next sheet
-        outFile.write('...')
-        outFile.close()
-        logger.info('Completed output file %s', outFile)
+    if jobs > 1 and len(worksheets) > 1:
+        jobs = min(jobs, len(worksheets))
+        logger.info('Converting sheets with %d worker processes', jobs)
+        # Tag each log line with the worker that produced it
+        if ch is not None:
+            ch.setFormatter(workerFormatter)
+        tasks = [(sheet.title, sourceformat, format, streaming, group,
+            cellRange, types, anchors) for sheet in worksheets]
+        try:
+            with worker_pool(jobs, _initWorker,
+                    (source, True, outputs)) as pool:
+                results = pool.map(_convertWorkerSheet, tasks, chunksize=1)
+        finally:
+            if ch is not None:
+                ch.setFormatter(formatter)
+        for outName, exported in results:
+            if exported is not None:
+                outputs.merge(group, exported)
+    else:
+        for sheet in worksheets:
+            convertSheet(sheet, sourceformat=sourceformat, format=format,
+                streaming=streaming, manifest=outputs, group=group,
+                cellRange=cellRange, types=types, anchors=anchors)
+
+    if incremental:
+        saveManifest(manifest, fingerprints)
+    if outputs is not None:
+        summary = outputs.save()
+        logger.info('%d files written, %d unchanged, %d removed',
+            len(summary['written']), len(summary['skipped']),
+            len(summary['removed']))
         
     logger.info('Completed execution of xlyaml')
     
@@ -443,27 +1451,90 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument("source", type=str, 
-            help="Source Excel file")
+            help="Source Excel file, CSV/TSV file or directory of them")
     parser.add_argument("-l", "--loglevel", 
             choices=['INFO', 'DEBUG'], default = 'INFO',
             help="Logging level; defaults to 'INFO'")
     parser.add_argument("-f", "--sourceformat",
             choices=['table', 'list'], default = 'list',
             help="Format of Excel spreadsheet")
+    parser.add_argument("-s", "--streaming", action="store_true",
+            help="Open workbook read-only and parse rows as they stream")
+    parser.add_argument("-t", "--outformat",
+            choices=sorted(OUTPUT_EXTENSIONS), default='yaml',
+            help="Format of output files; defaults to 'yaml'")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+            help="Number of processes used to convert sheets; 0 uses "
+            "one per CPU, defaults to 1")
+    parser.add_argument("-i", "--incremental", action="store_true",
+            help="Only convert sheets that changed since the last "
+            "incremental run")
+    parser.add_argument("-m", "--manifest", type=str, default=MANIFEST,
+            help="Manifest used by incremental runs; defaults to "
+            "'%s'" % MANIFEST)
+    parser.add_argument("--outputs", type=str,
+            help="Output manifest. Files whose content is unchanged since "
+            "the last run with this manifest are not rewritten, files that "
+            "are written are replaced atomically, and files of sheets no "
+            "longer in the workbook are removed")
+    parser.add_argument("-n", "--sheet", type=str, action="append",
+            help="Only convert this sheet; may be given more than once")
+    parser.add_argument("-r", "--range", type=str,
+            help="Only convert this range of cells of each sheet, e.g. "
+            "'A1:D20'")
+    parser.add_argument("--index", type=str, default=INDEX,
+            help="Workbook index caching sheet names, dimensions and "
+            "fingerprints; defaults to '%s'" % INDEX)
+    parser.add_argument("--list", action="store_true",
+            help="List the sheets of the workbook and their dimensions, "
+            "from the workbook index, instead of converting them")
+    parser.add_argument("-y", "--typed", action="store_true",
+            help="Keep numbers, booleans and dates as they are instead of "
+            "reading every cell as a string")
+    parser.add_argument("--types", type=str,
+            help="YAML file mapping table columns or list keys to a type "
+            "(%s); implies --typed" % ', '.join(sorted(CELL_TYPES)))
+    parser.add_argument("-a", "--anchors", action="store_true",
+            help="Write lists and dicts repeated within a sheet once, as "
+            "YAML anchors, and refer back to them with aliases")
+    parser.add_argument("--profile", type=str,
+            help="Write the wall time, call count and memory use of each "
+            "phase, sheet and output file to this JSON report")
+    parser.add_argument("--cprofile", type=str,
+            help="Write a cProfile capture of the run to this file, in "
+            "pstats format")
     args = parser.parse_args()
     
     if args.loglevel == 'INFO':
-        logger.setLevel(logging.INFO)
-        ch.setLevel(logging.INFO)
+        setupLogging(logging.INFO)
     elif args.loglevel == 'DEBUG':
-        logger.setLevel(logging.DEBUG)
-        ch.setLevel(logging.DEBUG)
+        setupLogging(logging.DEBUG)
         logger.debug('Setting logging level to DEBUG')
 
     sourceformat = args.sourceformat
         
     source = args.source
-    xlyaml(source, sourceformat=sourceformat)
+    if args.list:
+        index = workbookIndex(source, args.index)
+        for title in index['titles']:
+            print "%s\t%s" % (title, index['sheets'][title]['dimensions'])
+        sys.exit(0)
+
+    types = None
+    if args.types:
+        import yaml
+        with open(args.types, 'r') as f:
+            types = yaml.safe_load(f) or {}
+    elif args.typed:
+        types = {}
+
+    with profiling.profile(args.profile, args.cprofile,
+            enabled=bool(args.profile or args.cprofile)):
+        xlyaml(source, format=args.outformat, sourceformat=sourceformat,
+            streaming=args.streaming, jobs=args.jobs,
+            incremental=args.incremental, manifest=args.manifest,
+            outputs=args.outputs, sheets=args.sheet, cellrange=args.range,
+            index=args.index, types=types, anchors=args.anchors)
     
 '''####### TEST CASES #########
 